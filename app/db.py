@@ -1,6 +1,8 @@
 import os
 import asyncpg
 
+from app.settings import get_settings
+
 
 def get_database_url() -> str:
     url = os.getenv("DATABASE_URL", "").strip()
@@ -9,8 +11,32 @@ def get_database_url() -> str:
     return url
 
 
+# ✅ asyncpg は接続ごとに「SQL文字列 → prepared statement」をキャッシュする。
+#    ハンドラの SQL は定数なので、キャッシュを大きめ（既定 1024・DB_STATEMENT_CACHE_SIZE）にして parse/plan を初回だけにする。
+MAX_CACHEABLE_STATEMENT_SIZE = 64 * 1024  # 管理画面の長い SELECT もキャッシュ対象にする
+
+
+# ✅ 接続ごとのセッション設定（接続時の startup パラメータとして渡す）
+#    プールは接続を返すたびに RESET ALL するが、startup パラメータの値には戻るので効き続ける
+#    （接続直後に SET しても最初の1回しか効かない）
+#    - plan_cache_mode: キャッシュ済み prepared statement は毎回 custom plan を作らず generic plan を使い回す
+#    - jit: 小さい OLTP クエリでは JIT のコンパイル時間の方が高くつくので切る
+CONNECTION_SERVER_SETTINGS = {"plan_cache_mode": "force_generic_plan", "jit": "off"}
+
+
 async def create_pool() -> asyncpg.Pool:
-    return await asyncpg.create_pool(dsn=get_database_url(), min_size=1, max_size=5)
+    # プールの大きさは環境変数で調整（既定: 2〜10 本・60 秒使われなければ閉じる）
+    # webhook はユーザーごとに並行で DB を使うので、同時実行数に合わせて DB_POOL_MAX_SIZE を決める
+    settings = get_settings()
+    return await asyncpg.create_pool(
+        dsn=get_database_url(),
+        min_size=settings.db_pool_min_size,
+        max_size=settings.db_pool_max_size,
+        max_inactive_connection_lifetime=settings.db_pool_max_inactive_lifetime,
+        statement_cache_size=settings.db_statement_cache_size,
+        max_cacheable_statement_size=MAX_CACHEABLE_STATEMENT_SIZE,
+        server_settings=CONNECTION_SERVER_SETTINGS,
+    )
 
 
 async def init_db(pool: asyncpg.Pool) -> None:
@@ -73,6 +99,9 @@ async def init_db(pool: asyncpg.Pool) -> None:
 
     CREATE INDEX IF NOT EXISTS idx_conversations_provider ON conversations(provider);
     CREATE INDEX IF NOT EXISTS idx_conversations_last_seen ON conversations(last_seen_at);
+    -- ✅ 管理画面の keyset ページング用（provider ASC, created_at DESC）
+    CREATE INDEX IF NOT EXISTS idx_conversations_provider_created
+        ON conversations(provider, created_at DESC, conversation_id DESC);
 
     CREATE TABLE IF NOT EXISTS tasks (
         task_id        UUID PRIMARY KEY DEFAULT gen_random_uuid(),
@@ -138,6 +167,15 @@ async def init_db(pool: asyncpg.Pool) -> None:
 
     CREATE INDEX IF NOT EXISTS idx_tasks_is_pc_specific ON tasks(is_pc_specific);
 
+    -- ✅ LINE の「<タスク名>再実行」用：全角スペース/連続空白を正規化した名前（索引で引けるように生成列にする）
+    ALTER TABLE tasks
+        ADD COLUMN IF NOT EXISTS name_norm TEXT GENERATED ALWAYS AS (
+            regexp_replace(translate(name, '　', ' '), '\\s+', ' ', 'g')
+        ) STORED;
+
+    CREATE INDEX IF NOT EXISTS idx_tasks_user_name_norm
+    ON tasks(user_id, name_norm, created_at DESC);
+
     CREATE TABLE IF NOT EXISTS task_runs (
         run_id      UUID PRIMARY KEY DEFAULT gen_random_uuid(),
         task_id     UUID NOT NULL REFERENCES tasks(task_id) ON DELETE CASCADE,
@@ -187,11 +225,107 @@ async def init_db(pool: asyncpg.Pool) -> None:
     CREATE INDEX IF NOT EXISTS idx_rerun_queue_task_id
     ON task_rerun_queue(task_id);
 
+    -- ✅ 一覧の並び順（running → queued → その他）を生成列にして索引で読めるようにする
+    ALTER TABLE task_rerun_queue
+        ADD COLUMN IF NOT EXISTS status_rank SMALLINT GENERATED ALWAYS AS (
+            CASE status WHEN 'running' THEN 0 WHEN 'queued' THEN 1 ELSE 2 END
+        ) STORED;
+
+    -- ✅ 管理画面の keyset ページング用
+    CREATE INDEX IF NOT EXISTS idx_rerun_queue_rank_requested
+    ON task_rerun_queue(status_rank, requested_at DESC, request_id DESC);
+
+    CREATE INDEX IF NOT EXISTS idx_rerun_queue_status_requested
+    ON task_rerun_queue(status, requested_at DESC, request_id DESC);
+
+    -- ✅ 既定の「active」表示用。done/failed が溜まっても queued/running の分だけ読む
+    CREATE INDEX IF NOT EXISTS idx_rerun_queue_active_rank_requested
+    ON task_rerun_queue(status_rank, requested_at DESC, request_id DESC)
+    WHERE status IN ('queued', 'running');
+
     -- ★ queued/running の間は同じ task_id を重複させない（重要）
     CREATE UNIQUE INDEX IF NOT EXISTS uq_rerun_active_task
     ON task_rerun_queue(task_id)
     WHERE status IN ('queued', 'running');
 
+    -- ✅ 再実行キューの status 別件数（管理画面用のロールアップ・トリガーで維持）
+    CREATE TABLE IF NOT EXISTS task_rerun_queue_counts (
+        status TEXT PRIMARY KEY,
+        n      BIGINT NOT NULL DEFAULT 0
+    );
+
+    CREATE OR REPLACE FUNCTION task_rerun_queue_counts_trg() RETURNS trigger AS $$
+    BEGIN
+        IF TG_OP = 'UPDATE' AND OLD.status IS NOT DISTINCT FROM NEW.status THEN
+            RETURN NULL;
+        END IF;
+        IF TG_OP IN ('UPDATE', 'DELETE') THEN
+            UPDATE task_rerun_queue_counts SET n = n - 1 WHERE status = OLD.status;
+        END IF;
+        IF TG_OP IN ('INSERT', 'UPDATE') THEN
+            INSERT INTO task_rerun_queue_counts (status, n) VALUES (NEW.status, 1)
+            ON CONFLICT (status) DO UPDATE SET n = task_rerun_queue_counts.n + 1;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    -- ✅ 再実行キューの変更時刻（管理画面の ETag 用）。status 以外（locked_by / exit_code など）の更新でも進める
+    ALTER TABLE task_rerun_queue
+        ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW();
+
+    CREATE INDEX IF NOT EXISTS idx_rerun_queue_updated
+    ON task_rerun_queue(updated_at DESC);
+
+    CREATE OR REPLACE FUNCTION task_rerun_queue_touch_trg() RETURNS trigger AS $$
+    BEGIN
+        NEW.updated_at := NOW();
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    DROP TRIGGER IF EXISTS trg_task_rerun_queue_touch ON task_rerun_queue;
+    CREATE TRIGGER trg_task_rerun_queue_touch
+    BEFORE UPDATE ON task_rerun_queue
+    FOR EACH ROW EXECUTE FUNCTION task_rerun_queue_touch_trg();
+
+    -- ======================================================
+    -- ✅ 管理画面一覧の ETag 用：変更の目印を索引1回で読めるようにする（全件スキャンしない）
+    -- ======================================================
+    -- 更新は max(last_seen_at) / max(updated_at) で見る（conversations は idx_conversations_last_seen）
+    CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users(last_seen_at DESC);
+    CREATE INDEX IF NOT EXISTS idx_tasks_updated ON tasks(updated_at DESC);
+
+    -- 追加・削除は count(*) の代わりに表ごとの版番号で見る（トリガーで進める）
+    CREATE TABLE IF NOT EXISTS list_versions (
+        name    TEXT PRIMARY KEY,
+        version BIGINT NOT NULL DEFAULT 0
+    );
+
+    CREATE OR REPLACE FUNCTION list_versions_bump_trg() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO list_versions (name, version) VALUES (TG_TABLE_NAME, 1)
+        ON CONFLICT (name) DO UPDATE SET version = list_versions.version + 1;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    -- webhook の UPSERT（ON CONFLICT DO UPDATE）では INSERT トリガーは動かない（行レベルなので）
+    DROP TRIGGER IF EXISTS trg_users_list_version ON users;
+    CREATE TRIGGER trg_users_list_version
+    AFTER INSERT OR DELETE ON users
+    FOR EACH ROW EXECUTE FUNCTION list_versions_bump_trg();
+
+    DROP TRIGGER IF EXISTS trg_conversations_list_version ON conversations;
+    CREATE TRIGGER trg_conversations_list_version
+    AFTER INSERT OR DELETE ON conversations
+    FOR EACH ROW EXECUTE FUNCTION list_versions_bump_trg();
+
+    DROP TRIGGER IF EXISTS trg_tasks_list_version ON tasks;
+    CREATE TRIGGER trg_tasks_list_version
+    AFTER INSERT OR DELETE ON tasks
+    FOR EACH ROW EXECUTE FUNCTION list_versions_bump_trg();
+
     -- ======================================================
     -- ★ Stripe Webhook 受信ログ（冪等性・デバッグ用）
     -- ======================================================
@@ -208,8 +342,9 @@ async def init_db(pool: asyncpg.Pool) -> None:
         # ======================================================
         # ✅ 現行の利用規約バージョンを登録（なければ作成）
         # ======================================================
-        current_ver = os.getenv("CURRENT_TERMS_VERSION", "1.0").strip() or "1.0"
-        terms_url = os.getenv("TERMS_URL", "").strip()
+        settings = get_settings()
+        current_ver = settings.current_terms_version
+        terms_url = settings.terms_url
         # TERMS_URL が未設定なら /terms?v=... の相対URLにする（同一サーバー配信想定）
         if not terms_url:
             terms_url = f"/terms?v={current_ver}"
@@ -224,6 +359,24 @@ async def init_db(pool: asyncpg.Pool) -> None:
             terms_url,
         )
 
+        # ✅ 再実行キューの件数ロールアップ：トリガーを張り直して起動時に全件から作り直す
+        #    （ロック中は runner の INSERT/UPDATE を待たせるので、ずれが出ない）
+        async with conn.transaction():
+            await conn.execute(
+                """
+                LOCK TABLE task_rerun_queue IN SHARE ROW EXCLUSIVE MODE;
+
+                DROP TRIGGER IF EXISTS trg_task_rerun_queue_counts ON task_rerun_queue;
+                CREATE TRIGGER trg_task_rerun_queue_counts
+                AFTER INSERT OR DELETE OR UPDATE OF status ON task_rerun_queue
+                FOR EACH ROW EXECUTE FUNCTION task_rerun_queue_counts_trg();
+
+                DELETE FROM task_rerun_queue_counts;
+                INSERT INTO task_rerun_queue_counts (status, n)
+                SELECT status, COUNT(*) FROM task_rerun_queue GROUP BY status;
+                """
+            )
+
         # ✅ task_runs はログテーブルなので、無制限に増えないように保持期間で削除
         # （Railway などで常時起動していても、再デプロイ/再起動のタイミングで自然に掃除される）
         await conn.execute(
@@ -1,10 +1,14 @@
 import uuid
+import asyncio
 import os
+import time
+from collections import OrderedDict
 from datetime import datetime
-from typing import Any, Dict, List
+from typing import Any, Dict, List, Optional, Tuple, Union
 from urllib.parse import urlparse, parse_qsl, urlencode, urlunparse
 
 import httpx
+import orjson
 
 LINE_PROFILE_API = "https://api.line.me/v2/bot/profile/{}"
 LINE_REPLY_API = "https://api.line.me/v2/bot/message/reply"
@@ -31,6 +35,28 @@ PLAN_LABELS = {
 }
 
 
+# ✅ LINE API 用の HTTP クライアントはプロセスで1つ共有する（keep-alive で TCP/TLS 接続を使い回す）
+#    ワーカーが並行に返信するので keep-alive は多めに残す
+#    HTTP/2 で1本の接続に多重化する（h2 は requirements.txt で固定）
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=50, keepalive_expiry=75)
+_http_client: Optional[httpx.AsyncClient] = None
+
+
+def _client() -> httpx.AsyncClient:
+    global _http_client
+    if _http_client is None or _http_client.is_closed:
+        _http_client = httpx.AsyncClient(limits=HTTP_LIMITS, http2=True)
+    return _http_client
+
+
+async def aclose_http_client() -> None:
+    """shutdown 時に呼ぶ"""
+    global _http_client
+    if _http_client is not None:
+        await _http_client.aclose()
+        _http_client = None
+
+
 def _token() -> str:
     return os.getenv("LINE_CHANNEL_ACCESS_TOKEN", "").strip()
 
@@ -131,32 +157,67 @@ def _with_client_reference_id(base_url: str, client_reference_id: str) -> str:
         return f"{base_url}{sep}client_reference_id={client_reference_id}"
 
 
+# ✅ プロフィールは頻繁に変わらないので、直近に取れたものはしばらく使い回す（プロセス内 LRU）
+PROFILE_CACHE_TTL = 900.0  # seconds
+PROFILE_CACHE_MAX = 50_000
+_profile_cache: "OrderedDict[str, Tuple[float, Dict[str, Any]]]" = OrderedDict()
+# 同じユーザーの取得が同時に走ったら、1本の HTTP 呼び出しを共有する
+_profile_inflight: Dict[str, "asyncio.Future[Dict[str, Any]]"] = {}
+
+
+def invalidate_line_profile(user_id: str) -> None:
+    """キャッシュ済みプロフィールを捨てる（友だち追加し直しなど）"""
+    _profile_cache.pop(user_id, None)
+
+
 async def fetch_line_profile(user_id: str) -> Dict[str, Any]:
+    hit = _profile_cache.get(user_id)
+    if hit is not None and time.monotonic() - hit[0] < PROFILE_CACHE_TTL:
+        _profile_cache.move_to_end(user_id)
+        return hit[1]
+
+    fut = _profile_inflight.get(user_id)
+    if fut is None:
+        fut = asyncio.ensure_future(_fetch_line_profile(user_id))
+        _profile_inflight[user_id] = fut
+        fut.add_done_callback(lambda _: _profile_inflight.pop(user_id, None))
+    # 待っている側がキャンセルされても、共有中の取得は止めない
+    return await asyncio.shield(fut)
+
+
+async def _fetch_line_profile(user_id: str) -> Dict[str, Any]:
     token = _token()
     if not token:
         return {}
     headers = {"Authorization": f"Bearer {token}"}
     try:
-        async with httpx.AsyncClient() as client:
-            r = await client.get(LINE_PROFILE_API.format(user_id), headers=headers, timeout=7)
+        r = await _client().get(LINE_PROFILE_API.format(user_id), headers=headers, timeout=7)
         if r.status_code != 200:
             return {}
-        return r.json()
+        profile = r.json()
     except Exception:
         return {}
 
+    # 失敗（{}）はキャッシュしない
+    _profile_cache[user_id] = (time.monotonic(), profile)
+    _profile_cache.move_to_end(user_id)
+    while len(_profile_cache) > PROFILE_CACHE_MAX:
+        _profile_cache.popitem(last=False)
+    return profile
+
 
-async def reply_message(reply_token: str, messages: List[Dict[str, Any]]) -> bool:
+async def reply_message(reply_token: str, messages: Union[List[Dict[str, Any]], bytes]) -> bool:
+    """messages はエンコード済みの JSON 配列（bytes）でも受け付ける（固定の返信は毎回シリアライズしない）"""
     token = _token()
     if not token:
         return False
 
     headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
-    payload = {"replyToken": reply_token, "messages": messages}
+    raw_messages = messages if isinstance(messages, bytes) else orjson.dumps(messages)
+    content = b'{"replyToken":' + orjson.dumps(reply_token) + b',"messages":' + raw_messages + b"}"
 
     try:
-        async with httpx.AsyncClient() as client:
-            r = await client.post(LINE_REPLY_API, headers=headers, json=payload, timeout=10)
+        r = await _client().post(LINE_REPLY_API, headers=headers, content=content, timeout=10)
         if r.status_code != 200:
             print("LINE reply failed:", r.status_code, r.text)
             return False
@@ -173,8 +234,7 @@ async def unlink_rich_menu_from_user(user_id: str) -> bool:
         return False
     headers = {"Authorization": f"Bearer {token}"}
     try:
-        async with httpx.AsyncClient() as client:
-            r = await client.delete(LINE_UNLINK_RICH_MENU_API.format(user_id), headers=headers, timeout=10)
+        r = await _client().delete(LINE_UNLINK_RICH_MENU_API.format(user_id), headers=headers, timeout=10)
         return r.status_code in (200, 204, 404)
     except Exception:
         return False
@@ -190,8 +250,7 @@ async def link_rich_menu_to_user(user_id: str, rich_menu_id: str) -> bool:
         return False
     headers = {"Authorization": f"Bearer {token}"}
     try:
-        async with httpx.AsyncClient() as client:
-            r = await client.post(LINE_LINK_RICH_MENU_API.format(user_id, rich_menu_id), headers=headers, timeout=10)
+        r = await _client().post(LINE_LINK_RICH_MENU_API.format(user_id, rich_menu_id), headers=headers, timeout=10)
         if r.status_code not in (200, 201):
             print("LINE link rich menu failed:", r.status_code, r.text)
             return False
@@ -2,10 +2,11 @@ import uuid
 from fastapi import FastAPI
 
 from app.db import create_pool, init_db
+from app.line_api import aclose_http_client
 from app.auth import AdminAuthMiddleware
 from app.routers.public import router as public_router
 from app.routers.admin import router as admin_router
-from app.routers.webhook import router as webhook_router, legacy_router
+from app.routers.webhook import router as webhook_router, legacy_router, start_event_workers, stop_event_workers
 from app.routers.stripe_webhook import router as stripe_webhook_router
 app = FastAPI()
 app.add_middleware(AdminAuthMiddleware)
@@ -23,12 +24,16 @@ async def on_startup() -> None:
     # ★ ここは webhook.py 側も request.app.state.db_pool で参照する前提
     app.state.db_pool = pool
     await init_db(pool)
+    start_event_workers(app)
 
 @app.on_event("shutdown")
 async def on_shutdown() -> None:
+    # 受け付け済みの LINE イベントを処理し終えてから DB / HTTP クライアントを閉じる
+    await stop_event_workers(app)
     pool = getattr(app.state, "db_pool", None)
     if pool:
         await pool.close()
+    await aclose_http_client()
 
 @app.get("/debug/routes")
 def debug_routes():
@@ -1,24 +1,30 @@
 import re
+import base64
 import csv
+import hashlib
 import io
-from datetime import datetime, timedelta, date
+import uuid
+from datetime import datetime, timedelta, timezone, date
 from typing import Optional
+from urllib.parse import parse_qsl
 from zoneinfo import ZoneInfo
 
-from fastapi import APIRouter, Form, HTTPException, Request
-from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse
-from fastapi.templating import Jinja2Templates
+import orjson
+from fastapi import APIRouter, Depends, Form, HTTPException, Request
+from fastapi.responses import HTMLResponse, ORJSONResponse, RedirectResponse, Response, StreamingResponse
+from pydantic import ValidationError
 
 from app.auth import (
     SESSION_COOKIE, SESSION_MAX_AGE, SECURE_COOKIE,
     check_credentials, create_session_token,
     is_rate_limited, record_failed_attempt, reset_attempts,
 )
+from app.routers.webhook import forget_seen
+from app.schemas import TaskCreateForm, TaskMetaForm
+from app.templating import templates
 
 router = APIRouter(prefix="/admin")
-templates = Jinja2Templates(directory="app/templates")
 
-TIME_RE = re.compile(r"^\d{2}:\d{2}$")
 RUN_TIME_RE = re.compile(r"^\d{2}:\d{2}:\d{2}$")
 PLAN_TAGS = {"free", "paid", "expired", "test"}
 TASK_TYPES = {"mini", "normal"}
@@ -33,6 +39,94 @@ TASK_RUNS_PAGE_LIMIT = 500
 
 # rerun queue statuses
 RERUN_STATUSES = {"queued", "running", "done", "failed", "canceled"}
+# ?status= -> RERUN_QUEUE_SQL の種類
+RERUN_QUEUE_KINDS = {"active": "active", "all": "all", **{st: "status" for st in RERUN_STATUSES}}
+
+CONVERSATION_PROVIDERS = frozenset({"line", "lineworks"})
+TRUE_FLAGS = frozenset({"true", "1", "yes", "on"})
+
+# keyset ページング（OFFSET を使わず「前ページ最後の行より後」を取る）
+RERUN_QUEUE_PAGE_LIMIT = 100
+CONVERSATIONS_PAGE_LIMIT = 200
+
+# 一覧ページのキャッシュ制御
+# - POST 後のリダイレクト先にならないページは数秒だけブラウザキャッシュを許可
+# - それ以外は毎回再検証（ETag が一致すれば 304 で DB 取得と Jinja 描画を省略）
+LIST_CACHE_SHORT = "private, max-age=5"
+LIST_CACHE_REVALIDATE = "private, no-cache"
+
+
+def _list_etag(version_row) -> str:
+    """一覧の「版」（最終更新時刻・件数など）から弱い ETag を作る"""
+    digest = hashlib.sha1(repr(tuple(version_row)).encode("utf-8")).hexdigest()[:20]
+    return f'W/"{digest}"'
+
+
+def _encode_cursor(*values) -> str:
+    """keyset ページングのカーソル（最後の行のソートキー）を URL 用の文字列にする"""
+    raw = orjson.dumps(values, default=str)
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def _decode_cursor(cursor: Optional[str], size: int) -> Optional[list]:
+    """_encode_cursor の逆。壊れていれば 400"""
+    c = (cursor or "").strip()
+    if not c:
+        return None
+    try:
+        values = orjson.loads(base64.urlsafe_b64decode(c + "=" * (-len(c) % 4)))
+    except Exception:
+        raise HTTPException(status_code=400, detail="invalid cursor")
+    if not isinstance(values, list) or len(values) != size:
+        raise HTTPException(status_code=400, detail="invalid cursor")
+    return values
+
+
+def _parse_cursor_ts(value) -> datetime:
+    """カーソルの時刻（タイムゾーン付き ISO 形式のみ・UTC に揃えて範囲外もここで弾く）"""
+    try:
+        ts = datetime.fromisoformat(value)
+        if ts.tzinfo is None:
+            raise ValueError(value)
+        return ts.astimezone(timezone.utc)
+    except (TypeError, ValueError, OverflowError):
+        raise HTTPException(status_code=400, detail="invalid cursor")
+
+
+def _parse_cursor_uuid(value) -> str:
+    try:
+        return str(uuid.UUID(value))
+    except (TypeError, ValueError, AttributeError):
+        raise HTTPException(status_code=400, detail="invalid cursor")
+
+
+# status_rank は SMALLINT
+SMALLINT_MIN, SMALLINT_MAX = -32768, 32767
+
+
+def _parse_cursor_rank(value) -> int:
+    # JSON の整数のみ（bool・文字列・小数・範囲外は不正）
+    if type(value) is not int or not SMALLINT_MIN <= value <= SMALLINT_MAX:
+        raise HTTPException(status_code=400, detail="invalid cursor")
+    return value
+
+
+def _not_modified(request: Request, etag: str, cache_control: str) -> Optional[Response]:
+    """If-None-Match が一致すれば 304 を返す（不一致なら None）"""
+    if etag not in request.headers.get("if-none-match", ""):
+        return None
+    return Response(status_code=304, headers={"ETag": etag, "Cache-Control": cache_control})
+
+
+def _normalize_choice(value: Optional[str], default: str = "") -> str:
+    """小文字・前後空白なしに揃える（未指定なら default）。
+    空白だけの値は default にせず "" を返す（呼び出し側で不正な値として扱う）。
+    フォームの値はほぼ正規化済みなので、その場合は新しい文字列を作らずにそのまま返す"""
+    if not value:
+        return default
+    if value.islower() and not value[0].isspace() and not value[-1].isspace():
+        return value
+    return value.strip().lower()
 
 
 def _normalize_uuid(value: Optional[str]) -> Optional[str]:
@@ -118,10 +212,22 @@ async def admin_logout():
     return response
 
 
+USERS_VERSION_SQL = """
+SELECT
+    (SELECT max(last_seen_at) FROM users),
+    (SELECT version FROM list_versions WHERE name = 'users')
+"""
+
+
 @router.get("/users", response_class=HTMLResponse)
 async def admin_users(request: Request):
     pool = request.app.state.db_pool
     async with pool.acquire() as conn:
+        etag = _list_etag(await conn.fetchrow(USERS_VERSION_SQL))
+        not_modified = _not_modified(request, etag, LIST_CACHE_SHORT)
+        if not_modified:
+            return not_modified
+
         users = await conn.fetch(
             """
             SELECT user_id, user_name, picture_url, status_message, last_event, last_seen_at
@@ -130,59 +236,97 @@ async def admin_users(request: Request):
             LIMIT 400
             """
         )
-    return templates.TemplateResponse("admin_users.html", {"request": request, "title": "Users", "users": users})
+    return templates.TemplateResponse(
+        "admin_users.html",
+        {"request": request, "title": "Users", "users": users},
+        headers={"ETag": etag, "Cache-Control": LIST_CACHE_SHORT},
+    )
 
 
 # ======================================================
 # Tasks (全体一覧 / CSV)
 # ======================================================
 
+ALL_TASKS_SQL = """
+SELECT
+    t.task_id,
+    t.user_id,
+    u.user_name,
+    t.name,
+    t.script_key,
+    t.schedule_type,
+    t.schedule_value,
+    t.timezone,
+    t.enabled,
+    t.plan_tag,
+    t.task_type,
+    t.expires_at,
+    t.payment_date,
+    to_char(t.payment_date, 'YYYY:MM:DD') AS payment_date_str,
+    t.payment_amount,
+    t.pc_name,
+    to_char(t.run_time, 'HH24:MI:SS') AS run_time_hms,
+    t.is_pc_specific,
+    t.conversation_id,
+    c.provider AS conversation_provider,
+    c.destination AS conversation_destination,
+    c.display_name AS conversation_display_name,
+    t.created_at,
+    t.updated_at
+FROM tasks t
+LEFT JOIN users u ON u.user_id = t.user_id
+LEFT JOIN conversations c ON c.conversation_id = t.conversation_id
+ORDER BY t.created_at DESC
+LIMIT 2000
+"""
+
+# 一覧に出る tasks / users / conversations のどれかが変われば版が変わる
+# （max() は索引の端を読むだけ・追加/削除は list_versions の版番号で見る）
+ALL_TASKS_VERSION_SQL = """
+SELECT
+    (SELECT max(updated_at) FROM tasks),
+    (SELECT max(last_seen_at) FROM users),
+    (SELECT max(last_seen_at) FROM conversations),
+    (SELECT array_agg(name || ':' || version ORDER BY name) FROM list_versions
+     WHERE name IN ('tasks', 'conversations'))
+"""
+
+
+class RecordJSONResponse(ORJSONResponse):
+    """asyncpg の行をそのまま返す JSON（asyncpg の UUID など orjson 非対応の型は str にする）"""
+
+    def render(self, content) -> bytes:
+        return orjson.dumps(content, default=str)
+
+
 @router.get("/tasks", response_class=HTMLResponse)
 async def admin_tasks_all(request: Request):
     """全ユーザーのタスクを一覧表示。"""
     pool = request.app.state.db_pool
     async with pool.acquire() as conn:
-        tasks = await conn.fetch(
-            """
-            SELECT
-                t.task_id,
-                t.user_id,
-                u.user_name,
-                t.name,
-                t.script_key,
-                t.schedule_type,
-                t.schedule_value,
-                t.timezone,
-                t.enabled,
-                t.plan_tag,
-                t.task_type,
-                t.expires_at,
-                t.payment_date,
-                to_char(t.payment_date, 'YYYY:MM:DD') AS payment_date_str,
-                t.payment_amount,
-                t.pc_name,
-                to_char(t.run_time, 'HH24:MI:SS') AS run_time_hms,
-                t.is_pc_specific,
-                t.conversation_id,
-                c.provider AS conversation_provider,
-                c.destination AS conversation_destination,
-                c.display_name AS conversation_display_name,
-                t.created_at,
-                t.updated_at
-            FROM tasks t
-            LEFT JOIN users u ON u.user_id = t.user_id
-            LEFT JOIN conversations c ON c.conversation_id = t.conversation_id
-            ORDER BY t.created_at DESC
-            LIMIT 2000
-            """
-        )
+        etag = _list_etag(await conn.fetchrow(ALL_TASKS_VERSION_SQL))
+        not_modified = _not_modified(request, etag, LIST_CACHE_SHORT)
+        if not_modified:
+            return not_modified
+
+        tasks = await conn.fetch(ALL_TASKS_SQL)
 
     return templates.TemplateResponse(
         "admin_tasks_all.html",
         {"request": request, "title": "All Tasks", "tasks": tasks},
+        headers={"ETag": etag, "Cache-Control": LIST_CACHE_SHORT},
     )
 
 
+@router.get("/tasks.json")
+async def admin_tasks_all_json(request: Request):
+    """全タスクを JSON で返す（Jinja を通さず orjson で直接シリアライズ）。"""
+    pool = request.app.state.db_pool
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(ALL_TASKS_SQL)
+    return RecordJSONResponse({"tasks": [dict(r) for r in rows]})
+
+
 @router.get("/tasks.csv")
 async def admin_tasks_all_csv(request: Request):
     """全タスクのCSVをダウンロード。"""
@@ -421,10 +565,74 @@ async def admin_user_tasks(request: Request, user_id: str):
     )
 
 
-@router.post("/users/{user_id}/tasks")
-async def admin_create_task(
-    request: Request,
-    user_id: str,
+def _parse_expires_date(value: Optional[str]) -> Optional[datetime]:
+    """'YYYY-MM-DD' -> その日の 23:59:59 (JST)。空なら None"""
+    v = (value or "").strip()
+    if not v:
+        return None
+    try:
+        d = datetime.fromisoformat(v)
+    except Exception:
+        raise HTTPException(status_code=400, detail="expires_date must be YYYY-MM-DD")
+    return datetime(d.year, d.month, d.day, 23, 59, 59, tzinfo=JST)
+
+
+def _task_form_fields(
+    *,
+    pc_name: str,
+    run_time: str,
+    is_pc_specific: str,
+    conversation_id: Optional[str],
+    plan_tag: str,
+    task_type: str,
+    expires_date: Optional[str],
+    notes: Optional[str],
+    note_internal: Optional[str],
+    payment_date: Optional[str],
+    payment_amount: Optional[str],
+) -> dict:
+    """作成/更新フォーム共通の項目を検証・正規化する（不正なら 400）"""
+    plan_tag = (plan_tag or "free").strip()
+    if plan_tag not in PLAN_TAGS:
+        raise HTTPException(status_code=400, detail="plan_tag must be free, paid, expired, or test")
+
+    task_type = _normalize_choice(task_type, "normal") or "normal"
+    if task_type not in TASK_TYPES:
+        raise HTTPException(status_code=400, detail="task_type must be mini or normal")
+
+    return {
+        "pc_name": (pc_name or "default").strip() or "default",
+        # ✅ run_time: 'HH:MM:SS' -> timedelta
+        "run_time": parse_hhmmss_to_timedelta(run_time),
+        "is_pc_specific": _normalize_choice(is_pc_specific, "false") in TRUE_FLAGS,
+        "conversation_id": _normalize_uuid(conversation_id),
+        "plan_tag": plan_tag,
+        "task_type": task_type,
+        "expires_at": _parse_expires_date(expires_date),
+        "notes": (notes or "").strip() or None,
+        "note_internal": (note_internal or "").strip() or None,
+        "payment_date": parse_payment_date(payment_date),
+        "payment_amount": (payment_amount or "").strip() or None,
+    }
+
+
+# フォーム項目 -> 検証エラー時の 400 メッセージ
+TASK_FORM_ERRORS = {
+    "schedule_value": "schedule_value must be HH:MM",
+}
+
+
+def _validated_task_form(model, **values):
+    """TaskForm 系の生成（pydantic の検証エラーは 400 にする）"""
+    try:
+        return model(**values)
+    except ValidationError as e:
+        err = e.errors()[0]
+        field = str(err["loc"][0]) if err["loc"] else ""
+        raise HTTPException(status_code=400, detail=TASK_FORM_ERRORS.get(field) or f"{field}: {err['msg']}")
+
+
+def task_create_form(
     name: str = Form(...),
     script_key: str = Form(...),
     schedule_value: str = Form(...),
@@ -439,78 +647,94 @@ async def admin_create_task(
     conversation_id: Optional[str] = Form(None),
     payment_date: Optional[str] = Form(None),
     payment_amount: Optional[str] = Form(None),
-):
-    conversation_id = _normalize_uuid(conversation_id)
-    if not TIME_RE.match(schedule_value.strip()):
-        raise HTTPException(status_code=400, detail="schedule_value must be HH:MM")
-
-    pc_name = (pc_name or "default").strip() or "default"
-
-    # ✅ run_time: 'HH:MM:SS' -> timedelta
-    run_time_td = parse_hhmmss_to_timedelta(run_time)
-
-    is_pc_specific_bool = (is_pc_specific or "false").strip().lower() in {"true", "1", "yes", "on"}
+) -> TaskCreateForm:
+    """タスク作成フォームの依存関数（ハンドラ本体より前に検証する）"""
+    return _validated_task_form(
+        TaskCreateForm,
+        name=name,
+        script_key=script_key,
+        schedule_value=schedule_value,
+        **_task_form_fields(
+            pc_name=pc_name,
+            run_time=run_time,
+            is_pc_specific=is_pc_specific,
+            conversation_id=conversation_id,
+            plan_tag=plan_tag,
+            task_type=task_type,
+            expires_date=expires_date,
+            notes=notes,
+            note_internal=note_internal,
+            payment_date=payment_date,
+            payment_amount=payment_amount,
+        ),
+    )
 
-    plan_tag = (plan_tag or "free").strip()
-    if plan_tag not in PLAN_TAGS:
-        raise HTTPException(status_code=400, detail="plan_tag must be free, paid, expired, or test")
 
-    task_type = (task_type or "normal").strip().lower() or "normal"
-    if task_type not in TASK_TYPES:
-        raise HTTPException(status_code=400, detail="task_type must be mini or normal")
+def _build_task_meta_form(
+    *,
+    schedule_value: Optional[str],
+    pc_name: Optional[str],
+    run_time: Optional[str],
+    is_pc_specific: Optional[str],
+    conversation_id: Optional[str],
+    plan_tag: Optional[str],
+    task_type: Optional[str],
+    expires_date: Optional[str],
+    enabled: Optional[str],
+    notes: Optional[str],
+    note_internal: Optional[str],
+    payment_date: Optional[str],
+    payment_amount: Optional[str],
+) -> TaskMetaForm:
+    """タスク更新（フォーム / JSON 共通）の検証"""
+    return _validated_task_form(
+        TaskMetaForm,
+        # schedule_value（空なら 00:00）
+        schedule_value=(schedule_value or "").strip() or "00:00",
+        enabled=_normalize_choice(enabled, "true") in TRUE_FLAGS,
+        **_task_form_fields(
+            pc_name=pc_name,
+            run_time=run_time,
+            is_pc_specific=is_pc_specific,
+            conversation_id=conversation_id,
+            plan_tag=plan_tag,
+            task_type=task_type,
+            expires_date=expires_date,
+            notes=notes,
+            note_internal=note_internal,
+            payment_date=payment_date,
+            payment_amount=payment_amount,
+        ),
+    )
 
-    expires_at = None
-    if expires_date:
-        try:
-            d = datetime.fromisoformat(expires_date.strip())
-            expires_at = datetime(d.year, d.month, d.day, 23, 59, 59, tzinfo=JST)
-        except Exception:
-            raise HTTPException(status_code=400, detail="expires_date must be YYYY-MM-DD")
 
-    pool = request.app.state.db_pool
-    async with pool.acquire() as conn:
-        exists = await conn.fetchval("SELECT 1 FROM users WHERE user_id=$1", user_id)
-        if not exists:
-            raise HTTPException(status_code=404, detail="User not found")
+TASK_META_FIELDS = (
+    "schedule_value",
+    "pc_name",
+    "run_time",
+    "is_pc_specific",
+    "conversation_id",
+    "plan_tag",
+    "task_type",
+    "expires_date",
+    "enabled",
+    "notes",
+    "note_internal",
+    "payment_date",
+    "payment_amount",
+)
 
-        pay_date = parse_payment_date(payment_date)
-        pay_amount = (payment_amount or "").strip() or None
 
-        await conn.execute(
-            """
-            INSERT INTO tasks (user_id, name, script_key, schedule_type, schedule_value, timezone,
-                               enabled, notes, note_internal, plan_tag, task_type, expires_at,
-                               payment_date, payment_amount,
-                               pc_name, run_time, is_pc_specific, conversation_id)
-            VALUES ($1, $2, $3, 'daily_time', $4, 'Asia/Tokyo',
-                    TRUE, $5, $6, $7, $8, $9,
-                    $10, $11,
-                    $12, $13, $14, $15)
-            """,
-            user_id,
-            name.strip(),
-            script_key.strip(),
-            schedule_value.strip(),
-            (notes or "").strip() or None,
-            (note_internal or "").strip() or None,
-            plan_tag,
-            task_type,
-            expires_at,
-            pay_date,
-            pay_amount,
-            pc_name,
-            run_time_td,  # ✅ timedelta
-            is_pc_specific_bool,
-            conversation_id,
-        )
-
-    return RedirectResponse(url=f"/admin/users/{user_id}/tasks", status_code=303)
+def _json_form_value(value) -> Optional[str]:
+    """JSON の値をフォーム文字列と同じ扱いにそろえる（true/false/数値も可）"""
+    if value is None:
+        return None
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value)
 
 
-@router.post("/tasks/{task_id}/update")
-async def admin_update_task_meta(
-    request: Request,
-    task_id: str,
+def task_meta_form(
     schedule_value: str = Form("00:00"),
     pc_name: str = Form("default"),
     run_time: str = Form("00:00:00"),
@@ -524,58 +748,84 @@ async def admin_update_task_meta(
     note_internal: Optional[str] = Form(None),
     payment_date: Optional[str] = Form(None),
     payment_amount: Optional[str] = Form(None),
-):
-    # schedule_value
-    schedule_value = (schedule_value or "").strip()
-    if schedule_value and not TIME_RE.match(schedule_value):
-        raise HTTPException(status_code=400, detail="schedule_value must be HH:MM")
-
-    pc_name = (pc_name or "default").strip() or "default"
-
-    # ✅ run_time: 'HH:MM:SS' -> timedelta
-    run_time_td = parse_hhmmss_to_timedelta(run_time)
+) -> TaskMetaForm:
+    """タスク更新フォームの依存関数（ハンドラ本体より前に検証する）"""
+    return _build_task_meta_form(
+        schedule_value=schedule_value,
+        pc_name=pc_name,
+        run_time=run_time,
+        is_pc_specific=is_pc_specific,
+        conversation_id=conversation_id,
+        plan_tag=plan_tag,
+        task_type=task_type,
+        expires_date=expires_date,
+        enabled=enabled,
+        notes=notes,
+        note_internal=note_internal,
+        payment_date=payment_date,
+        payment_amount=payment_amount,
+    )
 
-    is_pc_specific_bool = (is_pc_specific or "false").strip().lower() in {"true", "1", "yes", "on"}
-    conversation_id = _normalize_uuid(conversation_id)
 
-    plan_tag = (plan_tag or "free").strip()
-    if plan_tag not in PLAN_TAGS:
-        raise HTTPException(status_code=400, detail="plan_tag must be free, paid, expired, or test")
-
-    task_type = (task_type or "normal").strip().lower() or "normal"
-    if task_type not in TASK_TYPES:
-        raise HTTPException(status_code=400, detail="task_type must be mini or normal")
+async def task_meta_json(request: Request) -> TaskMetaForm:
+    """タスク更新 JSON の依存関数（python-multipart を通さず orjson で読む）"""
+    try:
+        payload = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    if not isinstance(payload, dict):
+        raise HTTPException(status_code=400, detail="JSON object is required")
+    return _build_task_meta_form(**{k: _json_form_value(payload.get(k)) for k in TASK_META_FIELDS})
 
-    # enabled
-    enabled_bool = (enabled or "true").strip().lower() in {"true", "1", "yes", "on"}
 
-    # expires_at
-    expires_at = None
-    if expires_date is not None:
-        v = (expires_date or "").strip()
-        if v:
-            try:
-                d = datetime.fromisoformat(v)
-                expires_at = datetime(d.year, d.month, d.day, 23, 59, 59, tzinfo=JST)
-            except Exception:
-                raise HTTPException(status_code=400, detail="expires_date must be YYYY-MM-DD")
-        else:
-            expires_at = None
+@router.post("/users/{user_id}/tasks")
+async def admin_create_task(
+    request: Request,
+    user_id: str,
+    form: TaskCreateForm = Depends(task_create_form),
+):
+    pool = request.app.state.db_pool
+    async with pool.acquire() as conn:
+        # ✅ ユーザー存在確認と INSERT を1往復で（存在しなければ0行）
+        task_id = await conn.fetchval(
+            """
+            INSERT INTO tasks (user_id, name, script_key, schedule_type, schedule_value, timezone,
+                               enabled, notes, note_internal, plan_tag, task_type, expires_at,
+                               payment_date, payment_amount,
+                               pc_name, run_time, is_pc_specific, conversation_id)
+            SELECT $1, $2, $3, 'daily_time', $4, 'Asia/Tokyo',
+                   TRUE, $5, $6, $7, $8, $9,
+                   $10, $11,
+                   $12, $13, $14, $15
+            WHERE EXISTS (SELECT 1 FROM users WHERE user_id=$1)
+            RETURNING task_id
+            """,
+            user_id,
+            form.name,
+            form.script_key,
+            form.schedule_value,
+            form.notes,
+            form.note_internal,
+            form.plan_tag,
+            form.task_type,
+            form.expires_at,
+            form.payment_date,
+            form.payment_amount,
+            form.pc_name,
+            form.run_time,  # ✅ timedelta
+            form.is_pc_specific,
+            form.conversation_id,
+        )
+    if not task_id:
+        raise HTTPException(status_code=404, detail="User not found")
 
-    notes_norm = (notes or "").strip() or None
-    note_internal_norm = (note_internal or "").strip() or None
+    return RedirectResponse(url=f"/admin/users/{user_id}/tasks", status_code=303)
 
-    pay_date = parse_payment_date(payment_date)
-    pay_amount = (payment_amount or "").strip() or None
 
-    pool = request.app.state.db_pool
+async def _update_task_meta(pool, task_id: str, form: TaskMetaForm) -> str:
+    """タスクのメタ情報を更新し、所有者の user_id を返す"""
     async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT user_id FROM tasks WHERE task_id=$1", task_id)
-        if not row:
-            raise HTTPException(status_code=404, detail="Task not found")
-        user_id = row["user_id"]
-
-        await conn.execute(
+        user_id = await conn.fetchval(
             """
             UPDATE tasks
             SET schedule_value=$1,
@@ -593,57 +843,127 @@ async def admin_update_task_meta(
                 note_internal=$13,
                 updated_at=NOW()
             WHERE task_id=$14
+            RETURNING user_id
             """,
-            schedule_value or "00:00",
-            pc_name,
-            run_time_td,
-            is_pc_specific_bool,
-            conversation_id,
-            plan_tag,
-            task_type,
-            expires_at,
-            pay_date,
-            pay_amount,
-            enabled_bool,
-            notes_norm,
-            note_internal_norm,
+            form.schedule_value,
+            form.pc_name,
+            form.run_time,
+            form.is_pc_specific,
+            form.conversation_id,
+            form.plan_tag,
+            form.task_type,
+            form.expires_at,
+            form.payment_date,
+            form.payment_amount,
+            form.enabled,
+            form.notes,
+            form.note_internal,
             task_id,
         )
+    if not user_id:
+        raise HTTPException(status_code=404, detail="Task not found")
+    return user_id
 
+
+@router.post("/tasks/{task_id}/update")
+async def admin_update_task_meta(
+    request: Request,
+    task_id: str,
+    form: TaskMetaForm = Depends(task_meta_form),
+):
+    user_id = await _update_task_meta(request.app.state.db_pool, task_id, form)
     return RedirectResponse(url=f"/admin/users/{user_id}/tasks", status_code=303)
 
 
+@router.post("/tasks/{task_id}/update.json")
+async def admin_update_task_meta_json(
+    request: Request,
+    task_id: str,
+    form: TaskMetaForm = Depends(task_meta_json),
+):
+    """admin_update_task_meta の JSON 版（application/json を orjson で直接読む）"""
+    user_id = await _update_task_meta(request.app.state.db_pool, task_id, form)
+    return ORJSONResponse({"ok": True, "task_id": task_id, "user_id": user_id})
+
+
 # ======================================================
 # Conversations (通知先管理)
 # ======================================================
 
+# ✅ 1件多く取って「次ページがあるか」を判定する
+_CONVERSATIONS_SQL_TEMPLATE = """
+SELECT conversation_id, provider, destination, display_name, last_seen_at, created_at
+FROM conversations
+{where}
+ORDER BY provider ASC, created_at DESC, conversation_id DESC
+LIMIT {limit}
+"""
+
+CONVERSATIONS_FIRST_SQL = _CONVERSATIONS_SQL_TEMPLATE.format(where="", limit=CONVERSATIONS_PAGE_LIMIT + 1)
+CONVERSATIONS_AFTER_SQL = _CONVERSATIONS_SQL_TEMPLATE.format(
+    where="WHERE provider > $1 OR (provider = $1 AND (created_at, conversation_id) < ($2, $3::uuid))",
+    limit=CONVERSATIONS_PAGE_LIMIT + 1,
+)
+
+CONVERSATIONS_VERSION_SQL = """
+SELECT
+    (SELECT max(last_seen_at) FROM conversations),
+    (SELECT version FROM list_versions WHERE name = 'conversations')
+"""
+
+
 @router.get("/conversations", response_class=HTMLResponse)
-async def admin_conversations(request: Request):
+async def admin_conversations(request: Request, cursor: Optional[str] = None):
+    after = _decode_cursor(cursor, 3)
+    args = []
+    if after:
+        args = [str(after[0]), _parse_cursor_ts(after[1]), _parse_cursor_uuid(after[2])]
+
     pool = request.app.state.db_pool
     async with pool.acquire() as conn:
+        etag = _list_etag(await conn.fetchrow(CONVERSATIONS_VERSION_SQL))
+        not_modified = _not_modified(request, etag, LIST_CACHE_REVALIDATE)
+        if not_modified:
+            return not_modified
+
         conversations = await conn.fetch(
-            """
-            SELECT conversation_id, provider, destination, display_name, last_seen_at, created_at
-            FROM conversations
-            ORDER BY provider ASC, created_at DESC
-            LIMIT 800
-            """
+            CONVERSATIONS_AFTER_SQL if after else CONVERSATIONS_FIRST_SQL,
+            *args,
         )
+
+    next_cursor = None
+    if len(conversations) > CONVERSATIONS_PAGE_LIMIT:
+        conversations = conversations[:CONVERSATIONS_PAGE_LIMIT]
+        last = conversations[-1]
+        next_cursor = _encode_cursor(last["provider"], last["created_at"], last["conversation_id"])
+
     return templates.TemplateResponse(
         "admin_conversations.html",
-        {"request": request, "title": "Conversations", "conversations": conversations},
+        {
+            "request": request,
+            "title": "Conversations",
+            "conversations": conversations,
+            "cursor": cursor,
+            "next_cursor": next_cursor,
+        },
+        headers={"ETag": etag, "Cache-Control": LIST_CACHE_REVALIDATE},
     )
 
 
 @router.post("/conversations")
-async def admin_create_conversation(
-    request: Request,
-    provider: str = Form(...),
-    destination: str = Form(...),
-    display_name: Optional[str] = Form(None),
-):
-    provider = (provider or "").strip().lower()
-    if provider not in {"line", "lineworks"}:
+async def admin_create_conversation(request: Request):
+    # ✅ 管理画面のフォームは小さな urlencoded なので、本文をそのまま parse_qsl する
+    if request.headers.get("content-type", "").startswith("application/x-www-form-urlencoded"):
+        # 不正な UTF-8 は置換文字にする（フォームパーサーと同じく 500 にしない）
+        form = dict(parse_qsl((await request.body()).decode("utf-8", errors="replace"), keep_blank_values=True))
+    else:
+        form = await request.form()
+    provider = form.get("provider")
+    destination = form.get("destination")
+    display_name = form.get("display_name")
+
+    provider = _normalize_choice(provider)
+    if provider not in CONVERSATION_PROVIDERS:
         raise HTTPException(status_code=400, detail="provider must be line or lineworks")
 
     destination = (destination or "").strip()
@@ -675,7 +995,11 @@ async def admin_create_conversation(
 async def admin_delete_conversation(request: Request, conversation_id: str):
     pool = request.app.state.db_pool
     async with pool.acquire() as conn:
-        await conn.execute("DELETE FROM conversations WHERE conversation_id=$1", conversation_id)
+        destination = await conn.fetchval(
+            "DELETE FROM conversations WHERE conversation_id=$1 RETURNING destination", conversation_id
+        )
+    # ✅ webhook 側の保存済みキャッシュも外す（次のイベントで会話を作り直させる）
+    forget_seen(destination=destination)
     return RedirectResponse(url="/admin/conversations", status_code=303)
 
 
@@ -683,12 +1007,12 @@ async def admin_delete_conversation(request: Request, conversation_id: str):
 async def admin_toggle_task(request: Request, task_id: str):
     pool = request.app.state.db_pool
     async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT user_id, enabled FROM tasks WHERE task_id=$1", task_id)
-        if not row:
-            raise HTTPException(status_code=404, detail="Task not found")
-        new_enabled = not bool(row["enabled"])
-        await conn.execute("UPDATE tasks SET enabled=$1, updated_at=NOW() WHERE task_id=$2", new_enabled, task_id)
-        user_id = row["user_id"]
+        user_id = await conn.fetchval(
+            "UPDATE tasks SET enabled = NOT enabled, updated_at=NOW() WHERE task_id=$1 RETURNING user_id",
+            task_id,
+        )
+    if not user_id:
+        raise HTTPException(status_code=404, detail="Task not found")
     return RedirectResponse(url=f"/admin/users/{user_id}/tasks", status_code=303)
 
 
@@ -696,11 +1020,9 @@ async def admin_toggle_task(request: Request, task_id: str):
 async def admin_delete_task(request: Request, task_id: str):
     pool = request.app.state.db_pool
     async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT user_id FROM tasks WHERE task_id=$1", task_id)
-        if not row:
-            raise HTTPException(status_code=404, detail="Task not found")
-        user_id = row["user_id"]
-        await conn.execute("DELETE FROM tasks WHERE task_id=$1", task_id)
+        user_id = await conn.fetchval("DELETE FROM tasks WHERE task_id=$1 RETURNING user_id", task_id)
+    if not user_id:
+        raise HTTPException(status_code=404, detail="Task not found")
     return RedirectResponse(url=f"/admin/users/{user_id}/tasks", status_code=303)
 
 
@@ -708,81 +1030,146 @@ async def admin_delete_task(request: Request, task_id: str):
 # Rerun queue (再実行リスト)
 # ======================================================
 
+# ✅ status ごとの SQL は起動時に1回だけ組み立てる
+#    （文字列が毎回同一なので asyncpg の statement cache で prepared statement が再利用される）
+_RERUN_QUEUE_SQL_TEMPLATE = """
+SELECT
+  q.request_id,
+  q.status,
+  q.status_rank,
+  q.requested_at,
+  (q.requested_at AT TIME ZONE 'Asia/Tokyo') AS requested_at_jst,
+  (q.locked_at    AT TIME ZONE 'Asia/Tokyo') AS locked_at_jst,
+  q.locked_by,
+  (q.started_at   AT TIME ZONE 'Asia/Tokyo') AS started_at_jst,
+  (q.finished_at  AT TIME ZONE 'Asia/Tokyo') AS finished_at_jst,
+  q.exit_code,
+  q.pc_name AS original_pc_name,
+  q.requested_by,
+
+  t.task_id,
+  t.name AS task_name,
+  t.script_key,
+  t.pc_name AS task_pc_name,
+
+  u.user_id,
+  u.user_name
+FROM task_rerun_queue q
+JOIN tasks t ON t.task_id = q.task_id
+JOIN users u ON u.user_id = q.user_id
+{where}
+ORDER BY {order}
+LIMIT {limit}
+"""
+
+
+def _rerun_queue_sql(status_cond: str, n_status_args: int, after: bool) -> str:
+    """status 条件 + keyset 条件から一覧 SQL を作る（起動時のみ呼ぶ）"""
+    conds = [status_cond] if status_cond else []
+    if n_status_args:
+        # status 1種類なら status_rank は一定 → (status, requested_at) の索引順で読める
+        order = "q.requested_at DESC, q.request_id DESC"
+        if after:
+            conds.append("(q.requested_at, q.request_id) < ($2, $3::uuid)")
+    else:
+        # running → queued → その他 の順（status_rank は生成列 + 索引あり）
+        order = "q.status_rank, q.requested_at DESC, q.request_id DESC"
+        if after:
+            conds.append(
+                "(q.status_rank > $1 OR (q.status_rank = $1 AND (q.requested_at, q.request_id) < ($2, $3::uuid)))"
+            )
+    where = ("WHERE " + " AND ".join(conds)) if conds else ""
+    return _RERUN_QUEUE_SQL_TEMPLATE.format(where=where, order=order, limit=RERUN_QUEUE_PAGE_LIMIT + 1)
+
+
+# (status の種類, カーソル有無) -> SQL
+RERUN_QUEUE_SQL = {
+    (kind, after): _rerun_queue_sql(cond, n, after)
+    for kind, cond, n in (
+        ("active", "q.status IN ('queued','running')", 0),
+        ("all", "", 0),
+        ("status", "q.status=$1", 1),
+    )
+    for after in (False, True)
+}
+
+
+# status 別件数はトリガーで維持しているロールアップ表から読む（全件スキャンしない）
+RERUN_QUEUE_COUNTS_SQL = "SELECT status, n FROM task_rerun_queue_counts"
+
+
+def _rerun_queue_counts(rows) -> dict:
+    counts = {st: 0 for st in RERUN_STATUSES}
+    for r in rows:
+        counts[r["status"]] = r["n"]
+    counts["all"] = sum(counts.values())
+    return counts
+
+
 @router.get("/rerun-queue", response_class=HTMLResponse)
-async def admin_rerun_queue(request: Request, status: str = "active"):
+async def admin_rerun_queue(request: Request, status: str = "active", cursor: Optional[str] = None):
     """
     status:
       - active: queued + running
       - queued / running / done / failed / canceled
       - all
     """
-    status = (status or "active").strip().lower()
+    status = _normalize_choice(status, "active")
     pool = request.app.state.db_pool
 
-    where_sql = ""
-    args = []
-    if status == "active":
-        where_sql = "WHERE q.status IN ('queued','running')"
-    elif status == "all":
-        where_sql = ""
-    elif status in RERUN_STATUSES:
-        where_sql = "WHERE q.status=$1"
-        args = [status]
-    else:
+    kind = RERUN_QUEUE_KINDS.get(status)
+    if kind is None:
         raise HTTPException(status_code=400, detail="invalid status")
+    args = [status] if kind == "status" else []
 
-    sql = f"""
-    SELECT
-      q.request_id,
-      q.status,
-      (q.requested_at AT TIME ZONE 'Asia/Tokyo') AS requested_at_jst,
-      (q.locked_at    AT TIME ZONE 'Asia/Tokyo') AS locked_at_jst,
-      q.locked_by,
-      (q.started_at   AT TIME ZONE 'Asia/Tokyo') AS started_at_jst,
-      (q.finished_at  AT TIME ZONE 'Asia/Tokyo') AS finished_at_jst,
-      q.exit_code,
-      q.pc_name AS original_pc_name,
-      q.requested_by,
-
-      t.task_id,
-      t.name AS task_name,
-      t.script_key,
-      t.pc_name AS task_pc_name,
-
-      u.user_id,
-      u.user_name
-    FROM task_rerun_queue q
-    JOIN tasks t ON t.task_id = q.task_id
-    JOIN users u ON u.user_id = q.user_id
-    {where_sql}
-    ORDER BY
-      CASE q.status
-        WHEN 'running' THEN 0
-        WHEN 'queued'  THEN 1
-        ELSE 2
-      END,
-      q.requested_at DESC
-    LIMIT 400
-    """
+    # cursor = [status_rank, requested_at, request_id]（前ページ最後の行）
+    after = _decode_cursor(cursor, 3)
+    if after:
+        cursor_args = [_parse_cursor_ts(after[1]), _parse_cursor_uuid(after[2])]
+        if kind != "status":
+            cursor_args.insert(0, _parse_cursor_rank(after[0]))
+        args += cursor_args
+    sql = RERUN_QUEUE_SQL[(kind, after is not None)]
 
     async with pool.acquire() as conn:
-        items = await conn.fetch(sql, *args)
-        counts = await conn.fetchrow(
-            """
-            SELECT
-              COUNT(*) FILTER (WHERE status='queued')   AS queued,
-              COUNT(*) FILTER (WHERE status='running')  AS running,
-              COUNT(*) FILTER (WHERE status='done')     AS done,
-              COUNT(*) FILTER (WHERE status='failed')   AS failed,
-              COUNT(*) FILTER (WHERE status='canceled') AS canceled,
-              COUNT(*) AS all
-            FROM task_rerun_queue
-            """
+        etag = _list_etag(
+            await conn.fetchrow(
+                """
+                SELECT
+                  (SELECT array_agg(status || ':' || n ORDER BY status) FROM task_rerun_queue_counts),
+                  (SELECT max(updated_at) FROM task_rerun_queue),
+                  (SELECT max(updated_at) FROM tasks),
+                  (SELECT max(last_seen_at) FROM users)
+                """
+            )
         )
+        not_modified = _not_modified(request, etag, LIST_CACHE_REVALIDATE)
+        if not_modified:
+            return not_modified
+
+        # 件数はロールアップ表（数行）なので同じ接続で続けて読む（2本目の接続は借りない）
+        items = await conn.fetch(sql, *args)
+        count_rows = await conn.fetch(RERUN_QUEUE_COUNTS_SQL)
+    counts = _rerun_queue_counts(count_rows)
+
+    next_cursor = None
+    if len(items) > RERUN_QUEUE_PAGE_LIMIT:
+        items = items[:RERUN_QUEUE_PAGE_LIMIT]
+        last = items[-1]
+        next_cursor = _encode_cursor(last["status_rank"], last["requested_at"], last["request_id"])
 
     return templates.TemplateResponse(
         "admin_rerun_queue.html",
-        {"request": request, "title": "Rerun Queue", "items": items, "status": status, "counts": counts},
+        {
+            "request": request,
+            "title": "Rerun Queue",
+            "items": items,
+            "status": status,
+            "counts": counts,
+            "cursor": cursor,
+            "next_cursor": next_cursor,
+        },
+        headers={"ETag": etag, "Cache-Control": LIST_CACHE_REVALIDATE},
     )
 
 
@@ -791,15 +1178,20 @@ async def admin_cancel_rerun(request: Request, request_id: str):
     """Cancel queued item (runningは不可)."""
     pool = request.app.state.db_pool
     async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT status FROM task_rerun_queue WHERE request_id=$1", request_id)
-        if not row:
-            raise HTTPException(status_code=404, detail="request not found")
-        if row["status"] != "queued":
-            raise HTTPException(status_code=400, detail="only queued can be canceled")
-        await conn.execute(
-            "UPDATE task_rerun_queue SET status='canceled', finished_at=NOW() WHERE request_id=$1",
+        canceled = await conn.fetchval(
+            """
+            UPDATE task_rerun_queue SET status='canceled', finished_at=NOW()
+            WHERE request_id=$1 AND status='queued'
+            RETURNING 1
+            """,
             request_id,
         )
+        # 失敗時だけ理由（404 / 400）を確認する
+        if not canceled:
+            exists = await conn.fetchval("SELECT 1 FROM task_rerun_queue WHERE request_id=$1", request_id)
+            if not exists:
+                raise HTTPException(status_code=404, detail="request not found")
+            raise HTTPException(status_code=400, detail="only queued can be canceled")
     return RedirectResponse(url="/admin/rerun-queue?status=active", status_code=303)
 
 
@@ -808,10 +1200,18 @@ async def admin_delete_rerun(request: Request, request_id: str):
     """Delete a rerun record (done/failed/canceled only)."""
     pool = request.app.state.db_pool
     async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT status FROM task_rerun_queue WHERE request_id=$1", request_id)
-        if not row:
-            raise HTTPException(status_code=404, detail="request not found")
-        if row["status"] in ("queued", "running"):
+        deleted = await conn.fetchval(
+            """
+            DELETE FROM task_rerun_queue
+            WHERE request_id=$1 AND status NOT IN ('queued', 'running')
+            RETURNING 1
+            """,
+            request_id,
+        )
+        # 失敗時だけ理由（404 / 400）を確認する
+        if not deleted:
+            exists = await conn.fetchval("SELECT 1 FROM task_rerun_queue WHERE request_id=$1", request_id)
+            if not exists:
+                raise HTTPException(status_code=404, detail="request not found")
             raise HTTPException(status_code=400, detail="active item cannot be deleted")
-        await conn.execute("DELETE FROM task_rerun_queue WHERE request_id=$1", request_id)
     return RedirectResponse(url="/admin/rerun-queue?status=all", status_code=303)
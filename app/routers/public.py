@@ -1,68 +1,119 @@
 import uuid
-import os
+import asyncio
+import html
+import time
+from functools import lru_cache
 
 from fastapi import APIRouter, Request
-from fastapi.responses import HTMLResponse, JSONResponse
-from fastapi.templating import Jinja2Templates
+from fastapi.responses import HTMLResponse, JSONResponse, Response
+
+from app.settings import get_settings
+from app.templating import templates
 
 router = APIRouter()
-templates = Jinja2Templates(directory="app/templates")
 
 @router.get("/", response_class=HTMLResponse)
 async def home(request: Request):
     return templates.TemplateResponse("home.html", {"request": request, "title": "Home"})
 
+# ✅ ロードバランサ等から高頻度で叩かれるので、DB プローブ結果を短時間だけ使い回す
+HEALTH_CACHE_TTL = 1.0  # seconds
+HEALTH_PROBE_TIMEOUT = 2.0  # seconds
+_health_cache: tuple[float, dict] = (0.0, {})
+
+
+async def _probe_db(pool) -> int:
+    async with pool.acquire() as conn:
+        return await conn.fetchval("SELECT 1")
+
+
 @router.get("/health")
 async def health(request: Request):
+    global _health_cache
+    ts, cached = _health_cache
+    if cached and time.monotonic() - ts < HEALTH_CACHE_TTL:
+        return JSONResponse(cached)
+
     pool = getattr(request.app.state, "db_pool", None)
     if not pool:
         return JSONResponse({"status": "ng", "db_pool": "missing"})
     try:
-        async with pool.acquire() as conn:
-            n = await conn.fetchval("SELECT 1")
-        return JSONResponse({"status": "ok", "db": "postgres", "select_1": int(n)})
+        n = await asyncio.wait_for(_probe_db(pool), HEALTH_PROBE_TIMEOUT)
+        result = {"status": "ok", "db": "postgres", "select_1": int(n)}
     except Exception as e:
-        return JSONResponse({"status": "ng", "db": "postgres_error", "error": str(e)})
+        result = {"status": "ng", "db": "postgres_error", "error": str(e) or type(e).__name__}
+    _health_cache = (time.monotonic(), result)
+    return JSONResponse(result)
 
 
-@router.get("/terms", response_class=HTMLResponse)
-async def terms(request: Request, v: str | None = None):
-    current_ver = (os.getenv("CURRENT_TERMS_VERSION", "1.0").strip() or "1.0")
-    ver = (v or current_ver).strip() or current_ver
-    body = os.getenv("TERMS_BODY", "").strip()
+_PAGE_STYLE = (
+    "font-family: -apple-system,BlinkMacSystemFont,'Segoe UI',Roboto,Helvetica,Arial,"
+    "'Noto Sans JP','Hiragino Kaku Gothic ProN',Meiryo,sans-serif; line-height:1.6; padding:24px;"
+)
+_HTML_MEDIA_TYPE = "text/html; charset=utf-8"
+
+
+def _body_html(body: str, missing: str) -> str:
+    return html.escape(body).replace("\n", "<br>") if body else missing
 
-    html_body = body.replace("\n", "<br>") if body else (
+
+def _render_terms(ver: str) -> bytes:
+    settings = get_settings()
+    html_body = _body_html(
+        settings.terms_body,
         "（TERMS_BODY が未設定です。<br>"
-        "環境変数 TERMS_BODY に利用規約本文を入れるか、TERMS_URL を外部URLに設定してください。）"
+        "環境変数 TERMS_BODY に利用規約本文を入れるか、TERMS_URL を外部URLに設定してください。）",
     )
-
-    html = f"""
+    ver = html.escape(ver)
+    updated_at = html.escape(settings.terms_updated_at) or "（未設定）"
+    page = f"""
     <html><head><meta charset="utf-8"><title>利用規約 Ver.{ver}</title></head>
-    <body style="font-family: -apple-system,BlinkMacSystemFont,'Segoe UI',Roboto,Helvetica,Arial,'Noto Sans JP','Hiragino Kaku Gothic ProN',Meiryo,sans-serif; line-height:1.6; padding:24px;">
+    <body style="{_PAGE_STYLE}">
       <h1>利用規約（Ver.{ver}）</h1>
-      <p style="color:#666;">最終改定日：{os.getenv("TERMS_UPDATED_AT","").strip() or "（未設定）"}</p>
+      <p style="color:#666;">最終改定日：{updated_at}</p>
       <hr>
       <div>{html_body}</div>
     </body></html>
     """
-    return HTMLResponse(html)
+    return page.encode("utf-8")
 
 
-@router.get("/privacy", response_class=HTMLResponse)
-async def privacy(request: Request):
-    body = os.getenv("PRIVACY_BODY", "").strip()
-    html_body = body.replace("\n", "<br>") if body else (
+# ✅ 本文は環境変数から作るだけで実行中は変わらないので、現行版はバイト列ごと使い回す
+@lru_cache(maxsize=1)
+def _current_terms_page() -> bytes:
+    return _render_terms(get_settings().current_terms_version)
+
+
+@lru_cache(maxsize=1)
+def _privacy_page() -> bytes:
+    settings = get_settings()
+    html_body = _body_html(
+        settings.privacy_body,
         "（PRIVACY_BODY が未設定です。<br>"
-        "環境変数 PRIVACY_BODY にプライバシーポリシー本文を入れるか、PRIVACY_URL を外部URLに設定してください。）"
+        "環境変数 PRIVACY_BODY にプライバシーポリシー本文を入れるか、PRIVACY_URL を外部URLに設定してください。）",
     )
-
-    html = f"""
+    updated_at = html.escape(settings.privacy_updated_at) or "（未設定）"
+    page = f"""
     <html><head><meta charset="utf-8"><title>プライバシーポリシー</title></head>
-    <body style="font-family: -apple-system,BlinkMacSystemFont,'Segoe UI',Roboto,Helvetica,Arial,'Noto Sans JP','Hiragino Kaku Gothic ProN',Meiryo,sans-serif; line-height:1.6; padding:24px;">
+    <body style="{_PAGE_STYLE}">
       <h1>プライバシーポリシー</h1>
-      <p style="color:#666;">最終改定日：{os.getenv("PRIVACY_UPDATED_AT","").strip() or "（未設定）"}</p>
+      <p style="color:#666;">最終改定日：{updated_at}</p>
       <hr>
       <div>{html_body}</div>
     </body></html>
     """
-    return HTMLResponse(html)
+    return page.encode("utf-8")
+
+
+@router.get("/terms", response_class=HTMLResponse)
+async def terms(request: Request, v: str | None = None):
+    current_ver = get_settings().current_terms_version
+    ver = (v or current_ver).strip() or current_ver
+    # 旧バージョン指定（?v=...）のときだけ都度生成
+    content = _current_terms_page() if ver == current_ver else _render_terms(ver)
+    return Response(content=content, media_type=_HTML_MEDIA_TYPE)
+
+
+@router.get("/privacy", response_class=HTMLResponse)
+async def privacy(request: Request):
+    return Response(content=_privacy_page(), media_type=_HTML_MEDIA_TYPE)
@@ -2,15 +2,20 @@ from __future__ import annotations
 
 import hmac
 import hashlib
-import json
-import os
+import re
+import time
+from collections import OrderedDict
 from dataclasses import dataclass
+from functools import lru_cache
 from datetime import datetime, timezone
 from zoneinfo import ZoneInfo
 from typing import Any, Dict, Optional, Tuple
 
+import orjson
 from fastapi import APIRouter, Request, HTTPException
 
+from app.settings import get_settings
+
 
 router = APIRouter()
 
@@ -18,34 +23,47 @@ router = APIRouter()
 JST = ZoneInfo("Asia/Tokyo")
 
 
+# Stripe-Signature: t=1492774577,v1=5257a869e7...,v0=...
+# （シークレットのローテーション中は v1 が複数付くことがある）
+_SIG_ITEM_RE = re.compile(r"(?:^|,)\s*(t|v1)\s*=\s*([^,\s]+)")
+
+
 @dataclass
 class StripeSig:
     timestamp: int
-    v1: str
+    v1: Tuple[str, ...]
 
 
 def _parse_stripe_signature(header: str) -> StripeSig:
-    # Stripe-Signature: t=1492774577,v1=5257a869e7...,v0=...
-    parts = {}
-    for item in header.split(","):
-        if "=" not in item:
-            continue
-        k, v = item.split("=", 1)
-        parts[k.strip()] = v.strip()
-    if "t" not in parts or "v1" not in parts:
+    timestamp: Optional[int] = None
+    v1: list = []
+    for k, v in _SIG_ITEM_RE.findall(header):
+        if k == "t":
+            timestamp = int(v)
+        else:
+            v1.append(v)
+    if timestamp is None or not v1:
         raise ValueError("invalid stripe signature header")
-    return StripeSig(timestamp=int(parts["t"]), v1=parts["v1"])
+    return StripeSig(timestamp=timestamp, v1=tuple(v1))
+
+
+@lru_cache(maxsize=4)
+def _hmac_for_secret(secret: str) -> "hmac.HMAC":
+    """鍵の ipad/opad 計算済みの HMAC（リクエストごとに copy() して使う）"""
+    return hmac.new(secret.encode("utf-8"), digestmod=hashlib.sha256)
 
 
 def _verify_stripe_signature(raw_body: bytes, header: str, secret: str, tolerance_sec: int = 300) -> None:
     sig = _parse_stripe_signature(header)
-    now_ts = int(datetime.now(timezone.utc).timestamp())
+    now_ts = int(time.time())
     if abs(now_ts - sig.timestamp) > tolerance_sec:
         raise ValueError("timestamp outside tolerance")
 
-    signed_payload = f"{sig.timestamp}.".encode("utf-8") + raw_body
-    expected = hmac.new(secret.encode("utf-8"), signed_payload, hashlib.sha256).hexdigest()
-    if not hmac.compare_digest(expected, sig.v1):
+    h = _hmac_for_secret(secret).copy()
+    h.update(b"%d." % sig.timestamp)
+    h.update(raw_body)
+    expected = h.hexdigest()
+    if not any(hmac.compare_digest(expected, v1) for v1 in sig.v1):
         raise ValueError("signature mismatch")
 
 
@@ -60,22 +78,37 @@ def _extract_task_id_and_plan(client_reference_id: str) -> Tuple[str, Optional[s
     return s, None
 
 
+# 各月の日数（平年）。2月のうるう年だけ +1 する
+_DAYS_IN_MONTH = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+
 def _add_months(dt: datetime, months: int) -> datetime:
     # Simple month add that preserves day where possible.
-    import calendar
-
     year = dt.year
     month = dt.month + months
     year += (month - 1) // 12
     month = ((month - 1) % 12) + 1
-    last_day = calendar.monthrange(year, month)[1]
+    leap = year % 4 == 0 and (year % 100 != 0 or year % 400 == 0)
+    last_day = _DAYS_IN_MONTH[month - 1] + (month == 2 and leap)
     day = min(dt.day, last_day)
     return dt.replace(year=year, month=month, day=day)
 
 
+# 処理済み event_id の LRU（プロセス内・挿入順）
+RECENT_EVENTS_MAX = 4096
+_recent_events: "OrderedDict[str, None]" = OrderedDict()
+
+
+def _remember_event(event_id: str) -> None:
+    _recent_events[event_id] = None
+    _recent_events.move_to_end(event_id)
+    while len(_recent_events) > RECENT_EVENTS_MAX:
+        _recent_events.popitem(last=False)
+
+
 @router.post("/stripe/webhook")
 async def stripe_webhook(request: Request):
-    secret = os.getenv("STRIPE_WEBHOOK_SECRET", "").strip()
+    secret = get_settings().stripe_webhook_secret
     if not secret:
         # misconfiguration
         raise HTTPException(status_code=500, detail="STRIPE_WEBHOOK_SECRET is not set")
@@ -91,7 +124,7 @@ async def stripe_webhook(request: Request):
         raise HTTPException(status_code=400, detail=f"Invalid signature: {e}")
 
     try:
-        event = json.loads(raw.decode("utf-8"))
+        event = orjson.loads(raw)
     except Exception:
         raise HTTPException(status_code=400, detail="Invalid JSON")
 
@@ -104,6 +137,10 @@ async def stripe_webhook(request: Request):
 
     # Idempotency: store event_id (Stripe can retry)
     if event_id:
+        # ✅ 直近に処理したイベントの再送は DB に行く前に返す（最終的な判定は DB の一意制約）
+        if event_id in _recent_events:
+            _recent_events.move_to_end(event_id)
+            return {"ok": True, "duplicate": True}
         async with pool.acquire() as conn:
             inserted = await conn.fetchval(
                 """
@@ -113,8 +150,10 @@ async def stripe_webhook(request: Request):
                 RETURNING event_id
                 """,
                 event_id,
-                json.dumps(event),
+                # Stripe が送ってきた本文をそのまま保存（dict から再シリアライズしない）
+                raw.decode("utf-8"),
             )
+        _remember_event(event_id)
         if not inserted:
             # already processed
             return {"ok": True, "duplicate": True}
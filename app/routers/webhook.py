@@ -1,23 +1,35 @@
 import uuid
+import asyncio
 import base64
-import hashlib
+import binascii
 import hmac
-import os
+import logging
 import re
-from typing import Any, Dict, Optional
+import time
+import unicodedata
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+from urllib.parse import parse_qsl
 
 import asyncpg
-from fastapi import APIRouter, Header, HTTPException, Request
-from fastapi.responses import JSONResponse
+import orjson
+from fastapi import APIRouter, FastAPI, Header, HTTPException, Request
+from fastapi.responses import Response
+from pydantic import TypeAdapter, ValidationError
 
 from app.line_api import (
     build_tasks_flex,
     build_task_detail_flex,
     build_terms_agreement_flex,
     fetch_line_profile,
+    invalidate_line_profile,
     reply_message,
     set_user_rich_menu,
 )
+from app.schemas import LineEvent
+from app.settings import get_settings
+
+logger = logging.getLogger(__name__)
 
 # ✅ LINE側が /line/webhook に投げてるので prefix を /line にする
 router = APIRouter(prefix="/line")
@@ -26,191 +38,321 @@ router = APIRouter(prefix="/line")
 # ==========================
 # LINE署名検証
 # ==========================
+# この大きさ以上の本文は署名検証をイベントループの外（スレッド）で行う
+LINE_SIGNATURE_THREAD_MIN_BYTES = 64 * 1024
+
+
+@lru_cache(maxsize=1)
+def _line_secret_key() -> bytes:
+    return get_settings().line_channel_secret.encode("utf-8")
+
+
 def verify_line_signature(body: bytes, x_line_signature: Optional[str]) -> None:
-    secret = os.getenv("LINE_CHANNEL_SECRET", "").strip()
-    if not secret:
+    key = _line_secret_key()
+    if not key:
         return
     if not x_line_signature:
         raise HTTPException(status_code=400, detail="Missing x-line-signature")
-    mac = hmac.new(secret.encode("utf-8"), body, hashlib.sha256).digest()
-    expected = base64.b64encode(mac).decode("utf-8")
-    if not hmac.compare_digest(expected, x_line_signature):
+    # ワンショットの hmac.digest（HMAC オブジェクトを作らない）で計算し、署名側をデコードしてバイト列で比較
+    mac = hmac.digest(key, body, "sha256")
+    try:
+        given = base64.b64decode(x_line_signature, validate=True)
+    except (binascii.Error, ValueError):
+        raise HTTPException(status_code=400, detail="Invalid signature")
+    if not hmac.compare_digest(mac, given):
         raise HTTPException(status_code=400, detail="Invalid signature")
 
 
 # ==========================
 # コマンド判定
 # ==========================
+@lru_cache(maxsize=1)
 def _current_terms_version() -> str:
-    v = os.getenv("CURRENT_TERMS_VERSION", "1.0").strip()
-    return v or "1.0"
+    return get_settings().current_terms_version
 
 
+@lru_cache(maxsize=8)
 def _terms_url(current_ver: str) -> str:
-    url = os.getenv("TERMS_URL", "").strip()
+    url = get_settings().terms_url
     if url:
         return url
     # 同一サーバーで配信する想定（相対URL）
     return f"/terms?v={current_ver}"
 
 
+@lru_cache(maxsize=1)
 def _privacy_url() -> str:
-    return os.getenv("PRIVACY_URL", "").strip()
+    return get_settings().privacy_url
+
 
+# postback の data は自前の Flex が作る action / task_id / ver 程度なので、項目数に上限を設ける
+POSTBACK_MAX_FIELDS = 8
 
+
+@lru_cache(maxsize=1024)
 def _parse_postback_data(data: str) -> Dict[str, str]:
-    """action=agree_terms&ver=1.3 のような data を dict にする"""
-    out: Dict[str, str] = {}
-    for part in (data or "").split("&"):
-        if not part:
-            continue
-        if "=" in part:
-            k, v = part.split("=", 1)
-            out[k] = v
-        else:
-            out[part] = ""
-    return out
+    """action=agree_terms&ver=1.3 のような data を dict にする（%xx エスケープも戻す）
+    同じ data（LINE の再送・同じボタンの連打）は使い回すので、戻り値は書き換えないこと"""
+    try:
+        return dict(parse_qsl(data or "", keep_blank_values=True, max_num_fields=POSTBACK_MAX_FIELDS))
+    except ValueError:
+        return {}
 
 
-async def _has_agreed_current_terms(pool: asyncpg.Pool, user_id: str, current_ver: str) -> bool:
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT agreed_terms_version FROM users WHERE user_id=$1", user_id)
-    if not row:
-        return False
-    return (row["agreed_terms_version"] or "").strip() == current_ver
+# ✅ user_id -> 同意済みの規約バージョン（プロセス内キャッシュ）
+#    同意の書き込みはこの webhook からしか行わないので、DB で確認できた値と同意時の値だけを覚える
+#    （DB を手で直した場合に備えて AGREED_CACHE_TTL 秒で読み直す）
+AGREED_CACHE_MAX = 100_000
+AGREED_CACHE_TTL = 3600.0  # seconds
+_agreed_versions: Dict[str, Tuple[str, float]] = {}
 
 
-def parse_rerun_command(text: str) -> Optional[str]:
-    """Parse rerun command.
+def _remember_agreed(user_id: str, ver: str) -> None:
+    if len(_agreed_versions) >= AGREED_CACHE_MAX and user_id not in _agreed_versions:
+        _agreed_versions.clear()
+    _agreed_versions[user_id] = (ver, time.monotonic() + AGREED_CACHE_TTL)
 
-    Accepts:
-      - <task_name>再実行
-      - <task_name> 再実行 (half-width spaces)
-      - <task_name>　再実行 (full-width spaces)
-      - Any mix of half/full-width spaces between name and 再実行
 
-    Returns task_name if matched, otherwise None.
-    """
-    t = (text or "").strip()
-    if not t:
+def _cached_agreed_version(user_id: str) -> Optional[str]:
+    hit = _agreed_versions.get(user_id)
+    if hit is None:
         return None
-
-    # Allow zero or more half/full-width spaces right before "再実行" at end-of-text.
-    m = re.match(r"^(?P<task_name>.+?)[ \u3000]*再実行$", t)
-    if not m:
+    if hit[1] <= time.monotonic():
+        _agreed_versions.pop(user_id, None)
         return None
+    return hit[0]
+
 
-    name = (m.group("task_name") or "").strip()
-    return name or None
+async def _has_agreed_current_terms(
+    pool: asyncpg.Pool, user_id: str, current_ver: str, conn: Optional[asyncpg.Connection] = None
+) -> bool:
+    if _cached_agreed_version(user_id) == current_ver:
+        return True
+    sql = "SELECT agreed_terms_version FROM users WHERE user_id=$1"
+    row = await (pool if conn is None else conn).fetchrow(sql, user_id, timeout=_db_timeout())
+    if not row:
+        return False
+    agreed = (row["agreed_terms_version"] or "").strip()
+    if agreed:
+        _remember_agreed(user_id, agreed)
+    return agreed == current_ver
+
+
+# ✅ 規約同意：同意済みかの確認・同意ログ（同じ版は1回だけ）・ユーザー側の「最新同意」を1文・1往復で行う
+#    すでに同じ版に同意済みなら何も書かず true を返す（prev は更新前の値を読む）
+_AGREE_TERMS_SQL = """
+WITH prev AS (
+  SELECT btrim(agreed_terms_version) = $2 AS agreed
+  FROM users
+  WHERE user_id=$1
+),
+log AS (
+  INSERT INTO terms_agreements (user_id, terms_version, channel, source)
+  SELECT $1, $2, 'line', 'postback'
+  WHERE NOT EXISTS (SELECT 1 FROM prev WHERE agreed)
+  ON CONFLICT (user_id, terms_version) DO NOTHING
+),
+upd AS (
+  UPDATE users
+  SET agreed_terms_version=$2, agreed_terms_at=NOW()
+  WHERE user_id=$1 AND NOT EXISTS (SELECT 1 FROM prev WHERE agreed)
+)
+SELECT EXISTS (SELECT 1 FROM prev WHERE agreed) AS already_agreed
+"""
+
+
+# ✅ コマンド判定は1回の正規表現マッチで行う
+#   - tasks / task / タスク / たすく（英字は大文字小文字を区別しない）
+#   - <task_name>再実行（名前と「再実行」の間は半角/全角スペース 0 個以上）
+_COMMAND_RE = re.compile(
+    r"^\s*(?:(?P<tasks>tasks?|タスク|たすく)|(?P<task_name>.+?)[ \u3000]*再実行)\s*$",
+    re.IGNORECASE,
+)
+_TASKS_COMMANDS = frozenset({"tasks", "task", "タスク", "たすく"})
+
+CMD_TASKS = "tasks"
+CMD_RERUN = "rerun"
 
 
-def is_tasks_command(text: str) -> bool:
-    t = (text or "").strip().lower()
-    return t in {"tasks", "task", "タスク", "たすく"}
+def parse_command(text: str) -> Tuple[Optional[str], Optional[str]]:
+    """メッセージ本文 -> (コマンド種別, タスク名)。コマンドでなければ (None, None)"""
+    m = _COMMAND_RE.match(text or "")
+    if m is None:
+        # NFKC で全角英字（ＴＡＳＫＳ）や半角カナ（ﾀｽｸ）も同じ表記に寄せる（ASCII だけの本文は不要）
+        if text and not text.isascii() and unicodedata.normalize("NFKC", text).strip().lower() in _TASKS_COMMANDS:
+            return CMD_TASKS, None
+        return None, None
+    if m.group("tasks"):
+        return CMD_TASKS, None
+    name = m.group("task_name").strip()
+    return (CMD_RERUN, name) if name else (None, None)
 
 
 # ==========================
 # DB操作
 # ==========================
-async def upsert_user_from_profile(conn: asyncpg.Connection, user_id: str, profile: Dict[str, Any]) -> None:
+@lru_cache(maxsize=1)
+def _db_timeout() -> Optional[float]:
+    """webhook の SQL に渡す timeout（None = 無制限）"""
+    return get_settings().line_db_timeout or None
+
+
+@lru_cache(maxsize=1)
+def _db_sem() -> asyncio.Semaphore:
+    """webhook の DB 処理の同時実行数（バーストでプールを使い切って管理画面を待たせない）"""
+    return asyncio.Semaphore(max(1, get_settings().line_db_concurrency))
+
+
+# source.type -> 宛先ID（U/C/R...）のキー
+_DESTINATION_KEYS = {"user": "userId", "group": "groupId", "room": "roomId"}
+
+
+# ✅ 直近に保存したユーザー（保存した値）と宛先を覚えておき、同じ内容の UPSERT を省く
+#    last_seen_at は最大 SEEN_CACHE_TTL 秒遅れる（値が変わったとき・期限切れ・友だち追加では必ず保存する）
+SEEN_CACHE_TTL = 600.0  # seconds
+SEEN_CACHE_MAX = 50_000
+UserRow = Tuple[Optional[str], Optional[str], Optional[str], str]  # user_name, picture_url, status_message, last_event
+_seen_users: Dict[str, Tuple[UserRow, float]] = {}
+_seen_destinations: Dict[str, float] = {}
+
+
+def _remember_seen(user_rows: Dict[str, UserRow], dests: List[str]) -> None:
+    expires = time.monotonic() + SEEN_CACHE_TTL
+    if len(_seen_users) + len(user_rows) > SEEN_CACHE_MAX:
+        _seen_users.clear()
+    if len(_seen_destinations) + len(dests) > SEEN_CACHE_MAX:
+        _seen_destinations.clear()
+    for uid, row in user_rows.items():
+        _seen_users[uid] = (row, expires)
+    for d in dests:
+        _seen_destinations[d] = expires
+
+
+def forget_seen(user_id: Optional[str] = None, destination: Optional[str] = None) -> None:
+    """キャッシュから外す（友だち追加/ブロック・管理画面での会話削除のあとは必ず保存し直させる）"""
+    if user_id:
+        _seen_users.pop(user_id, None)
+    if destination:
+        _seen_destinations.pop(destination, None)
+
+
+async def upsert_users_and_conversations(
+    conn: asyncpg.Connection,
+    profiles: Dict[str, Dict[str, Any]],
+    last_events: Dict[str, str],
+    dests: List[str],
+) -> None:
+    """バッチ内の users（プロフィール）と conversations（通知先の自動保存）を1文・1往復で UPSERT する。
+    profiles / last_events は user_id ごと。dests は重複なし（同じ宛先を1文で2回更新するとエラーになる）"""
+    # ✅ 行ロックはキーの昇順で取る（並行するワーカー同士が逆順にロックしてデッドロックしないように）
+    user_ids = sorted(profiles)
+    dests = sorted(dests)
+    if not user_ids and not dests:
+        return
     sql = """
-    INSERT INTO users (user_id, user_name, picture_url, status_message, last_seen_at)
-    VALUES ($1, $2, $3, $4, NOW())
+    WITH conv AS (
+        INSERT INTO conversations (provider, destination, last_seen_at)
+        SELECT 'line', d.destination, NOW()
+        FROM UNNEST($6::text[]) AS d(destination)
+        ORDER BY d.destination
+        ON CONFLICT (provider, destination)
+        DO UPDATE SET last_seen_at=NOW()
+    )
+    INSERT INTO users (user_id, user_name, picture_url, status_message, last_event, last_seen_at)
+    SELECT u.user_id, u.user_name, u.picture_url, u.status_message, u.last_event, NOW()
+    FROM UNNEST($1::text[], $2::text[], $3::text[], $4::text[], $5::text[])
+         AS u(user_id, user_name, picture_url, status_message, last_event)
+    ORDER BY u.user_id
     ON CONFLICT (user_id)
     DO UPDATE SET
         user_name=EXCLUDED.user_name,
         picture_url=EXCLUDED.picture_url,
         status_message=EXCLUDED.status_message,
+        last_event=EXCLUDED.last_event,
         last_seen_at=NOW()
     """
     await conn.execute(
         sql,
-        user_id,
-        profile.get("displayName"),
-        profile.get("pictureUrl"),
-        profile.get("statusMessage"),
+        user_ids,
+        [profiles[uid].get("displayName") for uid in user_ids],
+        [profiles[uid].get("pictureUrl") for uid in user_ids],
+        [profiles[uid].get("statusMessage") for uid in user_ids],
+        [last_events.get(uid) for uid in user_ids],
+        dests,
+        timeout=_db_timeout(),
     )
 
 
-def _extract_line_destination(ev: Dict[str, Any]) -> Optional[str]:
-    """LINEの宛先ID（U/C/R...）をイベントから取り出す"""
-    src = ev.get("source") or {}
-    t = src.get("type")
-    if t == "group":
-        return src.get("groupId")
-    if t == "room":
-        return src.get("roomId")
-    if t == "user":
-        return src.get("userId")
-    return None
-
-
-async def upsert_line_conversation(conn: asyncpg.Connection, ev: Dict[str, Any]) -> None:
-    """イベントを受け取ったタイミングで conversations を自動保存（UPSERT）"""
-    dest = _extract_line_destination(ev)
-    if not dest:
-        return
-    sql = """
-    INSERT INTO conversations (provider, destination, last_seen_at)
-    VALUES ('line', $1, NOW())
-    ON CONFLICT (provider, destination)
-    DO UPDATE SET last_seen_at=NOW()
-    """
-    await conn.execute(sql, dest)
-
-
-async def enqueue_rerun(pool: asyncpg.Pool, user_id: str, task_name: str, requested_by: Optional[str]) -> Dict[str, Any]:
+async def enqueue_rerun(
+    pool: asyncpg.Pool,
+    user_id: str,
+    task_name: str,
+    requested_by: Optional[str],
+    conn: Optional[asyncpg.Connection] = None,
+) -> Dict[str, Any]:
     # ✅ 全角スペース/連続空白を正規化して比較（"通勤バス　乗車記録" 対策）
-    sql_find = r"""
-    SELECT task_id, pc_name, enabled
-    FROM tasks
-    WHERE user_id=$1
-      AND regexp_replace(translate(name, '　', ' '), '\s+', ' ', 'g')
-          = regexp_replace(translate($2,  '　', ' '), '\s+', ' ', 'g')
-    ORDER BY created_at DESC
-    LIMIT 1
+    #    tasks.name_norm は同じ式の生成列（user_id, name_norm で索引あり）
+    # ✅ タスク検索とキュー追加を1文（1往復）で行う
+    #    - task_id が NULL: タスクなし / enabled=false: 無効 / request_id が NULL: すでに待ち・実行中
+    sql = r"""
+    WITH t AS (
+        SELECT task_id, pc_name, enabled
+        FROM tasks
+        WHERE user_id=$1
+          AND name_norm = regexp_replace(translate($2, '　', ' '), '\s+', ' ', 'g')
+        ORDER BY created_at DESC
+        LIMIT 1
+    ),
+    ins AS (
+        INSERT INTO task_rerun_queue (task_id, user_id, pc_name, requested_by, status)
+        SELECT task_id, $1, pc_name, $3, 'queued' FROM t WHERE enabled
+        ON CONFLICT DO NOTHING
+        RETURNING request_id
+    )
+    SELECT t.task_id, t.pc_name, t.enabled, (SELECT request_id FROM ins) AS request_id
+    FROM (SELECT 1) AS one
+    LEFT JOIN t ON TRUE
     """
 
-    sql_insert = """
-    INSERT INTO task_rerun_queue (task_id, user_id, pc_name, requested_by, status)
-    VALUES ($1, $2, $3, $4, 'queued')
-    ON CONFLICT DO NOTHING
-    RETURNING request_id
-    """
+    row = await (pool if conn is None else conn).fetchrow(
+        sql, user_id, task_name, requested_by, timeout=_db_timeout()
+    )
 
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow(sql_find, user_id, task_name)
-        if not row:
-            return {"ok": False, "reason": "not_found"}
+    if row["task_id"] is None:
+        return {"ok": False, "reason": "not_found"}
 
-        if not bool(row["enabled"]):
-            return {"ok": False, "reason": "disabled"}
+    if not bool(row["enabled"]):
+        return {"ok": False, "reason": "disabled"}
 
-        request_id = await conn.fetchval(sql_insert, row["task_id"], user_id, row["pc_name"], requested_by)
-        if not request_id:
-            return {"ok": False, "reason": "already_pending"}
+    request_id = row["request_id"]
+    if not request_id:
+        return {"ok": False, "reason": "already_pending"}
 
-        return {
-            "ok": True,
-            "request_id": str(request_id),
-            "task_id": str(row["task_id"]),
-            "pc_name": row["pc_name"],
-        }
+    return {
+        "ok": True,
+        "request_id": str(request_id),
+        "task_id": str(row["task_id"]),
+        "pc_name": row["pc_name"],
+    }
 
 
-async def fetch_tasks_for_user(pool: asyncpg.Pool, user_id: str) -> list[dict]:
+async def fetch_tasks_for_user(
+    pool: asyncpg.Pool, user_id: str, conn: Optional[asyncpg.Connection] = None
+) -> List[asyncpg.Record]:
+    """Record のまま返す（Flex 側は .get() / [] でしか読まないので dict に詰め替えない）
+    conn を渡したときはその接続で実行する（無ければ pool.fetch で借りてすぐ返す）"""
     sql = """
     SELECT task_id, name, schedule_value, plan_tag, task_type, expires_at, enabled
     FROM tasks
     WHERE user_id=$1
     ORDER BY created_at DESC
     """
-    async with pool.acquire() as conn:
-        rows = await conn.fetch(sql, user_id)
-    return [dict(r) for r in rows]
+    return await (pool if conn is None else conn).fetch(sql, user_id, timeout=_db_timeout())
 
 
-async def fetch_task_detail_for_user(pool: asyncpg.Pool, user_id: str, task_id: str) -> Optional[dict]:
+async def fetch_task_detail_for_user(
+    pool: asyncpg.Pool, user_id: str, task_id: str, conn: Optional[asyncpg.Connection] = None
+) -> Optional[asyncpg.Record]:
     """task_id 指定で詳細を取得（user_id も一致するもののみ）"""
     sql = """
     SELECT task_id, name, schedule_value, plan_tag, task_type, expires_at, payment_date, payment_amount, notes, stripe_payment_link
@@ -218,209 +360,364 @@ async def fetch_task_detail_for_user(pool: asyncpg.Pool, user_id: str, task_id:
     WHERE user_id=$1 AND task_id=$2::uuid
     LIMIT 1
     """
-    async with pool.acquire() as conn:
-        row = await conn.fetchrow(sql, user_id, task_id)
-    return dict(row) if row else None
+    return await (pool if conn is None else conn).fetchrow(sql, user_id, task_id, timeout=_db_timeout())
 
 
 # ==========================
 # Webhook endpoint
 # ==========================
-@router.post("/webhook")  # ✅ /line/webhook
-async def line_webhook(
-    request: Request,
-    x_line_signature: Optional[str] = Header(default=None),
-) -> JSONResponse:
-    body = await request.body()
-    verify_line_signature(body, x_line_signature)
+HANDLED_EVENT_TYPES = frozenset({"follow", "postback", "message"})
+_LINE_EVENT_ADAPTER: TypeAdapter[LineEvent] = TypeAdapter(LineEvent)
+
+
+def _handled_events(raw_events: Any) -> List[LineEvent]:
+    """扱う種類のイベントだけを検証して返す（replyToken / userId が無い＝返信できないものは捨てる）
+    検証済みのイベントは使うキーだけを持つので、以降は ev["source"]["userId"] のように直接読む"""
+    if not isinstance(raw_events, list):
+        return []
+    events: List[LineEvent] = []
+    for ev in raw_events:
+        if not isinstance(ev, dict):
+            continue
+        # ブロック（unfollow）は処理しないが、保存済みキャッシュだけはここで外す
+        if ev.get("type") == "unfollow" and isinstance(ev.get("source"), dict):
+            src = ev["source"]
+            forget_seen(src.get("userId"), src.get(_DESTINATION_KEYS.get(src.get("type"), "")))
+        if ev.get("type") not in HANDLED_EVENT_TYPES:
+            continue
+        try:
+            events.append(_LINE_EVENT_ADAPTER.validate_python(ev))
+        except ValidationError:
+            continue
+    return events
 
-    payload = await request.json()
-    events = payload.get("events") or []
 
-    # ✅ main.py は app.state.db_pool
-    pool: asyncpg.Pool = request.app.state.db_pool
+# ✅ 返信文は固定なので import 時にエンコードまで済ませておく（reply_message は bytes をそのまま送る）
+def _text_reply(text: str) -> bytes:
+    return orjson.dumps([{"type": "text", "text": text}])
 
-    for ev in events:
-        ev_type = ev.get("type")
-        reply_token = ev.get("replyToken")
-        user_id = (ev.get("source") or {}).get("userId")
-        if not reply_token or not user_id:
-            continue
 
-        # プロフィール保存（displayName 等）
-        profile = await fetch_line_profile(user_id)
-        display_name = profile.get("displayName") or "user"
+@lru_cache(maxsize=4)
+def _terms_reply(current_ver: str) -> bytes:
+    """規約同意の Flex（返信 messages）。規約バージョンごとに1回だけ組み立てる"""
+    return orjson.dumps([build_terms_agreement_flex(current_ver, _terms_url(current_ver), _privacy_url())])
 
-        async with pool.acquire() as conn:
-            await upsert_line_conversation(conn, ev)  # ✅ groupId/roomId などを自動保存
-            await upsert_user_from_profile(conn, user_id, profile)
 
-        current_ver = _current_terms_version()
+_REPLY_TASK_ID_MISSING = _text_reply("タスクIDが取得できませんでした。")
+_REPLY_TASK_NOT_FOUND = _text_reply("タスクが見つかりませんでした。")
+_REPLY_TERMS_AGREED = _text_reply(
+    "利用規約へのご同意、ありがとうございます。\n"
+    "ご質問やご相談がありましたら、お気軽にお声がけください。"
+)
+_REPLY_RECEIVED = _text_reply(
+    "メッセージありがとうございます。\n"
+    "担当者が確認するまで、しばらくお待ちください。"
+)
 
-        # ==========================
-        # Follow（友だち追加）
-        # ==========================
-        if ev_type == "follow":
-            # 未同意用リッチメニュー（任意：IDが未設定なら何もしない）
-            await set_user_rich_menu(user_id, agreed=False)
-            flex = build_terms_agreement_flex(current_ver, _terms_url(current_ver), _privacy_url())
-            await reply_message(reply_token, [flex])
-            continue
+# enqueue_rerun の結果 -> 返信文（{0} はタスク名）
+_RERUN_MESSAGES = {
+    "ok": "「{0}」を再実行キューに追加しました。再実行までしばらくお待ちください。",
+    "not_found": "「{0}」が見つかりませんでした。",
+    "disabled": "「{0}」は disabled です。",
+    "already_pending": "「{0}」はすでに再実行待ち/実行中です。",
+}
+_MSG_RERUN_FAILED = "再実行の追加に失敗しました。"
+
+# LINE への応答本文は常に同じなので、エンコード済みのものを返す
+_OK_BODY = orjson.dumps({"ok": True})
+
+
+async def _handle_event(pool: asyncpg.Pool, ev: LineEvent, display_name: str, current_ver: str) -> None:
+    """1イベント分の処理（返信まで）"""
+    ev_type = ev["type"]
+    reply_token = ev["replyToken"]
+    user_id = ev["source"]["userId"]
+
+    # ==========================
+    # Follow（友だち追加）
+    # ==========================
+    if ev_type == "follow":
+        # 未同意用リッチメニュー（任意：IDが未設定なら何もしない）と返信は独立しているので並行に送る
+        await asyncio.gather(
+            set_user_rich_menu(user_id, agreed=False),
+            reply_message(reply_token, _terms_reply(current_ver)),
+        )
+        return
+
+    # ==========================
+    # Postback（同意など）
+    # ==========================
+    if ev_type == "postback":
+        data = (ev.get("postback") or {}).get("data") or ""
+        pb = _parse_postback_data(data)
 
         # ==========================
-        # Postback（同意など）
+        # タスク詳細（タスク名タップ）
         # ==========================
-        if ev_type == "postback":
-            data = (ev.get("postback") or {}).get("data") or ""
-            pb = _parse_postback_data(data)
-
-            # ==========================
-            # タスク詳細（タスク名タップ）
-            # ==========================
-            if pb.get("action") == "task_detail":
-                task_id = (pb.get("task_id") or "").strip()
-                if not task_id:
-                    await reply_message(reply_token, [{"type": "text", "text": "タスクIDが取得できませんでした。"}])
-                    continue
+        if pb.get("action") == "task_detail":
+            task_id = (pb.get("task_id") or "").strip()
+            if not task_id:
+                await reply_message(reply_token, _REPLY_TASK_ID_MISSING)
+                return
 
+            async with _db_sem():
                 task = await fetch_task_detail_for_user(pool, user_id, task_id)
-                if not task:
-                    await reply_message(reply_token, [{"type": "text", "text": "タスクが見つかりませんでした。"}])
-                    continue
-
-                flex = build_task_detail_flex(display_name, task)
-                await reply_message(reply_token, [flex])
-                continue
-
-            if pb.get("action") == "agree_terms":
-                agreed_ver = (pb.get("ver") or current_ver).strip() or current_ver
-
-                # ✅ すでに同じバージョンに同意済みなら、再送しない（=返信しない）
-                async with pool.acquire() as conn:
-                    row = await conn.fetchrow(
-                        "SELECT agreed_terms_version FROM users WHERE user_id=$1",
-                        user_id,
-                    )
-                if row and (row["agreed_terms_version"] or "").strip() == agreed_ver:
-                    # 任意：同意済みメニューへ寄せる（ID未設定なら何もしない）
-                    await set_user_rich_menu(user_id, agreed=True)
-                    continue
-
-                # 初回同意（または新バージョン同意）のときだけ保存＆返信
-                async with pool.acquire() as conn:
-                    # 同意ログ（同じ版は1回だけ）
-                    await conn.execute(
-                        """
-                        INSERT INTO terms_agreements (user_id, terms_version, channel, source)
-                        VALUES ($1, $2, 'line', 'postback')
-                        ON CONFLICT (user_id, terms_version) DO NOTHING
-                        """,
-                        user_id,
-                        agreed_ver,
-                    )
-                    # ユーザー側に「最新同意」をキャッシュ
-                    await conn.execute(
-                        """
-                        UPDATE users
-                        SET agreed_terms_version=$2, agreed_terms_at=NOW()
-                        WHERE user_id=$1
-                        """,
-                        user_id,
-                        agreed_ver,
+            if not task:
+                await reply_message(reply_token, _REPLY_TASK_NOT_FOUND)
+                return
+
+            flex = build_task_detail_flex(display_name, task)
+            await reply_message(reply_token, [flex])
+            return
+
+        if pb.get("action") == "agree_terms":
+            agreed_ver = (pb.get("ver") or current_ver).strip() or current_ver
+
+            already_agreed = _cached_agreed_version(user_id) == agreed_ver
+            if not already_agreed:
+                # 初回同意（または新バージョン同意）のときだけ保存される（確認と保存で1往復）
+                async with _db_sem():
+                    already_agreed = await pool.fetchval(
+                        _AGREE_TERMS_SQL, user_id, agreed_ver, timeout=_db_timeout()
                     )
+            _remember_agreed(user_id, agreed_ver)
 
-                await reply_message(
-                    reply_token,
-                    [
-                        {
-                            "type": "text",
-                            "text": (
-                                "利用規約へのご同意、ありがとうございます。\n"
-                                "ご質問やご相談がありましたら、お気軽にお声がけください。"
-                            ),
-                        }
-                    ],
-                )
-
-                # 同意済みリッチメニューへ（任意：IDが未設定なら何もしない）
+            # ✅ すでに同じバージョンに同意済みなら、再送しない（=返信しない）
+            if already_agreed:
+                # 任意：同意済みメニューへ寄せる（ID未設定なら何もしない）
                 await set_user_rich_menu(user_id, agreed=True)
+                return
 
-            continue
+            # 返信と同意済みリッチメニューへの切り替え（任意：IDが未設定なら何もしない）は並行に送る
+            await asyncio.gather(
+                reply_message(reply_token, _REPLY_TERMS_AGREED),
+                set_user_rich_menu(user_id, agreed=True),
+            )
 
-        # ==========================
-        # Text message
-        # ==========================
-        if ev_type != "message":
-            continue
+        return
 
-        message = ev.get("message") or {}
-        if message.get("type") != "text":
-            continue
+    # ==========================
+    # Text message
+    # ==========================
+    if ev_type != "message":
+        return
 
-        text = message.get("text") or ""
+    message = ev.get("message") or {}
+    if message.get("type") != "text":
+        return
 
-        # ✅ 規約同意ゲート（未同意ならここで止める）
-        if not await _has_agreed_current_terms(pool, user_id, current_ver):
-            # 未同意（または規約更新で再同意が必要）なら未同意メニューに戻す
-            await set_user_rich_menu(user_id, agreed=False)
-            flex = build_terms_agreement_flex(current_ver, _terms_url(current_ver), _privacy_url())
-            await reply_message(reply_token, [flex])
-            continue
+    text = message.get("text") or ""
+
+    command, task_name = parse_command(text)
+
+    # ✅ 同意確認とコマンドの DB 処理は1回の接続取得でまとめて行う
+    #    （同意がキャッシュ済みで DB を使わないメッセージは接続を取らない／返信は接続を返してから送る）
+    agreed = _cached_agreed_version(user_id) == current_ver
+    tasks: List[asyncpg.Record] = []
+    result: Dict[str, Any] = {}
+    if not agreed or command is not None:
+        async with _db_sem(), pool.acquire() as conn:
+            agreed = agreed or await _has_agreed_current_terms(pool, user_id, current_ver, conn=conn)
+            if agreed and command == CMD_TASKS:
+                tasks = await fetch_tasks_for_user(pool, user_id, conn=conn)
+            elif agreed and command == CMD_RERUN:
+                result = await enqueue_rerun(pool, user_id, task_name, requested_by=display_name, conn=conn)
+
+    # ✅ 規約同意ゲート（未同意ならここで止める）
+    if not agreed:
+        # 未同意（または規約更新で再同意が必要）なら未同意メニューに戻す
+        await asyncio.gather(
+            set_user_rich_menu(user_id, agreed=False),
+            reply_message(reply_token, _terms_reply(current_ver)),
+        )
+        return
 
-        # ==========================
-        # 既存コマンド
-        # ==========================
-        if is_tasks_command(text):
-            tasks = await fetch_tasks_for_user(pool, user_id)
-            flex = build_tasks_flex(display_name, tasks)
-            await reply_message(reply_token, [flex])
-            continue
+    # ==========================
+    # 既存コマンド
+    # ==========================
+    if command == CMD_TASKS:
+        flex = build_tasks_flex(display_name, tasks)
+        await reply_message(reply_token, [flex])
+        return
+
+    if command == CMD_RERUN:
+        template = _RERUN_MESSAGES.get("ok" if result["ok"] else result.get("reason"))
+        msg = template.format(task_name) if template else _MSG_RERUN_FAILED
+        await reply_message(reply_token, [{"type": "text", "text": msg}])
+        return
 
-        task_name = parse_rerun_command(text)
-        if task_name:
-            result = await enqueue_rerun(pool, user_id, task_name, requested_by=display_name)
+    # ==========================
+    # ✅ 未対応メッセージ：受付メッセージを返す
+    # ==========================
+    await reply_message(reply_token, _REPLY_RECEIVED)
 
-            if result["ok"]:
-                msg = f"「{task_name}」を再実行キューに追加しました。再実行までしばらくお待ちください。"
+
+async def _handle_user_events(
+    pool: asyncpg.Pool, events: List[LineEvent], display_name: str, current_ver: str
+) -> None:
+    """同じユーザーのイベントは受信順に処理する（同意 → メッセージ のような順序を崩さない）"""
+    for ev in events:
+        try:
+            await _handle_event(pool, ev, display_name, current_ver)
+        except Exception:
+            # 1件の失敗でバッチ全体を落とさない
+            logger.exception("LINE event failed: %s", ev["type"])
+
+
+# 保存の試行回数（デッドロック・一時的な接続エラーは1回だけやり直す）
+UPSERT_ATTEMPTS = 2
+
+
+async def _save_users_and_conversations(
+    pool: asyncpg.Pool, profiles: Dict[str, Dict[str, Any]], last_events: Dict[str, str], dests: List[str]
+) -> bool:
+    for attempt in range(1, UPSERT_ATTEMPTS + 1):
+        try:
+            async with _db_sem(), pool.acquire() as conn:
+                await upsert_users_and_conversations(conn, profiles, last_events, dests)
+            return True
+        except Exception:
+            if attempt < UPSERT_ATTEMPTS:
+                logger.warning("LINE webhook upsert failed, retrying", exc_info=True)
             else:
-                reason = result.get("reason")
-                if reason == "not_found":
-                    msg = f"「{task_name}」が見つかりませんでした。"
-                elif reason == "disabled":
-                    msg = f"「{task_name}」は disabled です。"
-                elif reason == "already_pending":
-                    msg = f"「{task_name}」はすでに再実行待ち/実行中です。"
-                else:
-                    msg = "再実行の追加に失敗しました。"
-
-            await reply_message(reply_token, [{"type": "text", "text": msg}])
-            continue
+                logger.exception("LINE webhook upsert failed (users=%d, dests=%d)", len(profiles), len(dests))
+    return False
 
-        # ==========================
-        # ✅ 未対応メッセージ：受付メッセージを返す
-        # ==========================
-        await reply_message(
-            reply_token,
-            [
-                {
-                    "type": "text",
-                    "text": (
-                        "メッセージありがとうございます。\n"
-                        "担当者が確認するまで、しばらくお待ちください。"
-                    ),
-                }
-            ],
+
+async def _process_events(pool: asyncpg.Pool, events: List[LineEvent]) -> None:
+    """フィルタ済みのイベント1バッチを処理する（プロフィール取得 → DB 保存 → 返信）"""
+    # source の読み出しはイベントごとに1回だけ（ユーザー別の振り分け・宛先・最終イベントをまとめて作る）
+    events_by_user: Dict[str, List[LineEvent]] = {}
+    last_events: Dict[str, str] = {}
+    dests: Dict[str, None] = {}
+    for ev in events:
+        src = ev["source"]
+        user_id = src["userId"]
+        ev_type = ev["type"]
+        events_by_user.setdefault(user_id, []).append(ev)
+        last_events[user_id] = ev_type
+        dest = src.get(_DESTINATION_KEYS.get(src.get("type"), ""))
+        if dest:
+            dests[dest] = None
+        # 友だち追加（し直し）のときはキャッシュを使わず取り直し、必ず保存する
+        if ev_type == "follow":
+            invalidate_line_profile(user_id)
+            forget_seen(user_id, dest)
+
+    # プロフィール取得（displayName 等）はユーザーごとに1回・並行して行う
+    user_ids = list(events_by_user)
+    profiles = dict(zip(user_ids, await asyncio.gather(*(fetch_line_profile(uid) for uid in user_ids))))
+
+    # 直近に同じ内容で保存済みのユーザー・宛先は書かない
+    now = time.monotonic()
+    user_rows: Dict[str, UserRow] = {}
+    for uid, profile in profiles.items():
+        row = (profile.get("displayName"), profile.get("pictureUrl"), profile.get("statusMessage"), last_events[uid])
+        hit = _seen_users.get(uid)
+        if hit is None or hit[1] <= now or hit[0] != row:
+            user_rows[uid] = row
+    new_dests = [d for d in dests if _seen_destinations.get(d, 0.0) <= now]
+
+    # プロフィール保存・通知先の自動保存（groupId/roomId など）はバッチ全体で1文にまとめる
+    # ✅ LINE には応答済みで再送されないので、保存に失敗しても返信・コマンド処理は続ける
+    if user_rows or new_dests:
+        saved = await _save_users_and_conversations(
+            pool, {uid: profiles[uid] for uid in user_rows}, last_events, new_dests
+        )
+        if saved:
+            _remember_seen(user_rows, new_dests)
+
+    # ✅ ユーザー間は並行に処理する（LINE API / DB の待ち時間を重ねる）
+    current_ver = _current_terms_version()
+    await asyncio.gather(
+        *(
+            _handle_user_events(pool, user_events, profiles[user_id].get("displayName") or "user", current_ver)
+            for user_id, user_events in events_by_user.items()
         )
-        continue
+    )
+
+
+# ==========================
+# イベント処理ワーカー
+# ==========================
+# 停止時にキューに残ったバッチを待つ上限（replyToken は短時間で失効するので長くは待たない）
+EVENT_QUEUE_DRAIN_TIMEOUT = 10.0  # seconds
+
+EventBatch = Tuple[asyncpg.Pool, List[LineEvent]]
+
+
+async def _event_worker(queue: "asyncio.Queue[EventBatch]") -> None:
+    while True:
+        pool, events = await queue.get()
+        try:
+            await _process_events(pool, events)
+        except Exception:
+            logger.exception("LINE webhook batch failed")
+        finally:
+            queue.task_done()
+
+
+def start_event_workers(app: FastAPI) -> None:
+    """webhook のバッチを受けるキューとワーカーを app.state に用意する（startup で呼ぶ）"""
+    settings = get_settings()
+    queue: "asyncio.Queue[EventBatch]" = asyncio.Queue(maxsize=settings.line_event_queue_size)
+    app.state.line_event_queue = queue
+    app.state.line_event_workers = [
+        asyncio.create_task(_event_worker(queue)) for _ in range(max(1, settings.line_event_workers))
+    ]
+
+
+async def stop_event_workers(app: FastAPI) -> None:
+    """キューに残ったバッチを（上限付きで）処理してからワーカーを止める（shutdown で DB プールより先に呼ぶ）"""
+    queue: Optional["asyncio.Queue[EventBatch]"] = getattr(app.state, "line_event_queue", None)
+    workers: List[asyncio.Task] = getattr(app.state, "line_event_workers", [])
+    if queue is not None:
+        try:
+            await asyncio.wait_for(queue.join(), timeout=EVENT_QUEUE_DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("LINE webhook queue not drained: %d batches left", queue.qsize())
+    for task in workers:
+        task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    app.state.line_event_workers = []
 
-    return JSONResponse({"ok": True})
+
+@router.post("/webhook")  # ✅ /line/webhook
+async def line_webhook(
+    request: Request,
+    x_line_signature: Optional[str] = Header(default=None),
+) -> Response:
+    body = await request.body()
+    # ✅ 大きいバッチの HMAC だけスレッドで計算する（小さい本文はスレッド切り替えの方が高くつく）
+    if len(body) >= LINE_SIGNATURE_THREAD_MIN_BYTES:
+        await asyncio.to_thread(verify_line_signature, body, x_line_signature)
+    else:
+        verify_line_signature(body, x_line_signature)
+
+    # 署名検証で読んだ本文をそのまま orjson でパースする（request.json() で読み直さない）
+    try:
+        payload = orjson.loads(body)
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    # 返信できるイベント（replyToken と userId があるもの）のうち、扱う種類だけを処理する
+    # （それ以外はプロフィール取得・DB 保存もしない）
+    events = _handled_events(payload.get("events") if isinstance(payload, dict) else None)
+
+    # ✅ main.py は app.state.db_pool
+    pool: asyncpg.Pool = request.app.state.db_pool
+
+    if not events:
+        return Response(content=_OK_BODY, media_type="application/json")
+
+    # ✅ 返信までの処理はワーカーに渡して先に 200 を返す（LINE への応答を下流の待ち時間に左右させない）
+    #    キューが一杯のときだけここで待つ（処理が追いつかないまま溜め込まない）
+    await request.app.state.line_event_queue.put((pool, events))
+
+    return Response(content=_OK_BODY, media_type="application/json")
 
 
 # ✅ 互換用：もしLINE側URLを /webhook にしていた場合でも受けられる
 # （prefix="/line" を使っているので、これは /webhook を追加するための別ルーターが必要）
+#   同じハンドラをそのまま登録する（ラッパー関数を挟まない）
 legacy_router = APIRouter()
-
-
-@legacy_router.post("/webhook")
-async def legacy_webhook(request: Request, x_line_signature: Optional[str] = Header(default=None)):
-    return await line_webhook(request, x_line_signature)
+legacy_router.add_api_route("/webhook", line_webhook, methods=["POST"])
@@ -1,18 +1,69 @@
 import uuid
-from pydantic import BaseModel, Field
+from datetime import date, datetime, timedelta
+from typing import Annotated
 
+from pydantic import BaseModel, ConfigDict, Field
+from typing_extensions import Required, TypedDict
 
-class TaskCreate(BaseModel):
-    name: str = Field(min_length=1, max_length=80)
-    script_key: str = Field(min_length=1, max_length=80)
-    schedule_value: str = Field(min_length=4, max_length=5)  # "HH:MM"
-    notes: str | None = Field(default=None, max_length=2000)
-    task_type: str | None = Field(default=None, max_length=20)
 
+# "HH:MM"
+SCHEDULE_VALUE_PATTERN = r"^\d{2}:\d{2}$"
 
-class TaskUpdate(BaseModel):
-    name: str | None = Field(default=None, max_length=80)
-    script_key: str | None = Field(default=None, max_length=80)
-    schedule_value: str | None = Field(default=None, max_length=5)
-    enabled: bool | None = None
-    notes: str | None = Field(default=None, max_length=2000)
+
+class TaskForm(BaseModel):
+    """管理画面のタスクフォーム（作成/更新で共通・検証済みの値）"""
+    # 前後の空白除去・HH:MM の形式チェック・未知のキーの拒否は pydantic-core 側で行う
+    model_config = ConfigDict(extra="forbid", str_strip_whitespace=True)
+
+    schedule_value: str = Field(pattern=SCHEDULE_VALUE_PATTERN)
+    pc_name: str
+    run_time: timedelta
+    is_pc_specific: bool
+    conversation_id: str | None = None
+    plan_tag: str
+    task_type: str
+    expires_at: datetime | None = None
+    notes: str | None = None
+    note_internal: str | None = None
+    payment_date: date | None = None
+    payment_amount: str | None = None
+
+
+class TaskCreateForm(TaskForm):
+    name: str
+    script_key: str
+
+
+class TaskMetaForm(TaskForm):
+    enabled: bool
+
+
+# ==========================
+# LINE webhook イベント（使うキーだけ・返信できるものだけ通す）
+# ==========================
+# pydantic は Python 3.12 未満では typing_extensions.TypedDict が必要
+NonEmptyStr = Annotated[str, Field(min_length=1)]
+
+
+class LineSource(TypedDict, total=False):
+    type: str
+    userId: Required[NonEmptyStr]
+    groupId: str
+    roomId: str
+
+
+class LineMessage(TypedDict, total=False):
+    type: str
+    text: str
+
+
+class LinePostback(TypedDict, total=False):
+    data: str
+
+
+class LineEvent(TypedDict, total=False):
+    type: Required[str]
+    replyToken: Required[NonEmptyStr]
+    source: Required[LineSource]
+    message: LineMessage
+    postback: LinePostback
@@ -0,0 +1,67 @@
+import os
+from dataclasses import dataclass
+from functools import lru_cache
+
+
+def _env(name: str, default: str = "") -> str:
+    return os.getenv(name, default).strip()
+
+
+def _env_int(name: str, default: int) -> int:
+    v = _env(name)
+    return int(v) if v else default
+
+
+def _env_float(name: str, default: float) -> float:
+    v = _env(name)
+    return float(v) if v else default
+
+
+@dataclass(slots=True, frozen=True)
+class Settings:
+    """実行中に変わらない環境変数（初回アクセス時に一度だけ読む）"""
+    stripe_webhook_secret: str
+    line_channel_secret: str
+    current_terms_version: str
+    terms_url: str
+    privacy_url: str
+    terms_body: str
+    terms_updated_at: str
+    privacy_body: str
+    privacy_updated_at: str
+    # DB 接続プール（DB_POOL_MIN_SIZE / DB_POOL_MAX_SIZE / DB_POOL_MAX_INACTIVE_LIFETIME / DB_STATEMENT_CACHE_SIZE）
+    # PgBouncer の transaction モード越しに繋ぐ場合は DB_STATEMENT_CACHE_SIZE=0 にする
+    db_pool_min_size: int
+    db_pool_max_size: int
+    db_pool_max_inactive_lifetime: float
+    db_statement_cache_size: int
+    # LINE webhook のイベント処理（LINE_EVENT_WORKERS 本のワーカー・最大 LINE_EVENT_QUEUE_SIZE バッチまで待たせる）
+    line_event_workers: int
+    line_event_queue_size: int
+    # webhook が同時に使う DB 接続の上限（LINE_DB_CONCURRENCY・既定はプール上限 - 2 で管理画面の分を残す）
+    line_db_concurrency: int
+    # webhook の SQL 1文の上限時間（秒・LINE_DB_TIMEOUT=0 で無制限）。起動時の init_db や管理画面には掛けない
+    line_db_timeout: float
+
+
+@lru_cache(maxsize=1)
+def get_settings() -> Settings:
+    return Settings(
+        stripe_webhook_secret=_env("STRIPE_WEBHOOK_SECRET"),
+        line_channel_secret=_env("LINE_CHANNEL_SECRET"),
+        current_terms_version=_env("CURRENT_TERMS_VERSION", "1.0") or "1.0",
+        terms_url=_env("TERMS_URL"),
+        privacy_url=_env("PRIVACY_URL"),
+        terms_body=_env("TERMS_BODY"),
+        terms_updated_at=_env("TERMS_UPDATED_AT"),
+        privacy_body=_env("PRIVACY_BODY"),
+        privacy_updated_at=_env("PRIVACY_UPDATED_AT"),
+        db_pool_min_size=_env_int("DB_POOL_MIN_SIZE", 2),
+        db_pool_max_size=_env_int("DB_POOL_MAX_SIZE", 10),
+        db_pool_max_inactive_lifetime=_env_float("DB_POOL_MAX_INACTIVE_LIFETIME", 60.0),
+        db_statement_cache_size=_env_int("DB_STATEMENT_CACHE_SIZE", 1024),
+        line_event_workers=_env_int("LINE_EVENT_WORKERS", 8),
+        line_event_queue_size=_env_int("LINE_EVENT_QUEUE_SIZE", 1000),
+        line_db_timeout=_env_float("LINE_DB_TIMEOUT", 30.0),
+        line_db_concurrency=_env_int("LINE_DB_CONCURRENCY", max(1, _env_int("DB_POOL_MAX_SIZE", 10) - 2)),
+    )
@@ -0,0 +1,14 @@
+from fastapi.templating import Jinja2Templates
+from jinja2 import Environment, FileSystemLoader, select_autoescape
+
+# ✅ テンプレート環境は全ルーターで1つだけ共有する
+#    - auto_reload=False: 描画ごとの stat()（更新チェック）をしない（テンプレ変更は再デプロイで反映）
+#    - enable_async は使わない（同期描画の方が速い）
+env = Environment(
+    loader=FileSystemLoader("app/templates"),
+    autoescape=select_autoescape(["html"]),
+    auto_reload=False,
+    cache_size=800,
+)
+
+templates = Jinja2Templates(env=env)